@@ -1,9 +1,12 @@
 from django.contrib import admin
 from django import forms
+from django.conf.urls.defaults import patterns, url
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
 
-from replicate.models import Host, Database, Conduit, Conduit_Set, Schedule, Log
-from utils import execute_conduit_manually, execute_schedule, execute_conduit_set
+from replicate.models import Host, Database, Conduit, ConduitRun, Checkpoint, Conduit_Set, Schedule, Log, Worker, Lease
+from executor import execute_conduit_manually, execute_schedule, execute_conduit_set
 
 #http://www.bromer.eu/2009/05/23/a-generic-copyclone-action-for-django-11/
 from django.db.models.fields import CharField
@@ -60,6 +63,69 @@ class LogAdmin(admin.ModelAdmin):
     order = 5
     actions = None
 
+
+class ConduitRunAdmin(admin.ModelAdmin):
+    date_hierarchy = 'started'
+    list_filter = ['status', 'conduit']
+    list_display = ['conduit', 'started', 'status', 'total_time', 'master_keys', 'slave_keys', 'rows_appended', 'rows_updated', 'rows_deleted', 'rows_per_second']
+    readonly_fields = ['conduit', 'status', 'started', 'finished', 'total_time'] + ['%s_time' % phase for phase in ConduitRun.PHASES] + ['master_keys', 'slave_keys', 'rows_appended', 'rows_updated', 'rows_deleted', 'rows_per_second', 'bytes_transferred']
+    order = 6
+    actions = None
+    #Amount of runs per conduit shown in the trends view
+    trend_runs = 30
+    phase_colors = ['#7b9fc4', '#c4a27b', '#9bc47b', '#4f7fb0', '#b07b4f', '#c47b9f', '#7bc4b8', '#a57bc4', '#c4c47b', '#c47b7b']
+
+    def get_urls(self):
+        urls = super(ConduitRunAdmin, self).get_urls()
+        return patterns('',
+            url(r'^trends/$', self.admin_site.admin_view(self.trends), name='replicate_conduitrun_trends'),
+        ) + urls
+
+    def trends(self, request):
+        trends = []
+        for conduit in Conduit.objects.all():
+            runs = list(ConduitRun.objects.filter(conduit=conduit).exclude(status='R')[:self.trend_runs])
+            if not runs:
+                continue
+            runs.reverse()
+            longest = max([run.total_time for run in runs]) or 1
+            fastest = max([run.rows_per_second for run in runs]) or 1
+            trends.append({
+                'conduit': conduit,
+                'runs': [{
+                    'run': run,
+                    'phases': [(name, seconds, seconds * 100 / longest, color) for (name, seconds), color in zip(run.phase_times(), self.phase_colors)],
+                    'rate_width': run.rows_per_second * 100 / fastest,
+                } for run in runs],
+            })
+
+        return render_to_response('admin/replicate/conduitrun/trends.html', {
+            'title': _(u'Conduit run trends'),
+            'trends': trends,
+            'legend': [(name, color) for (name, seconds), color in zip(ConduitRun().phase_times(), self.phase_colors)],
+            'app_label': ConduitRun._meta.app_label,
+            'module_name': ConduitRun._meta.verbose_name_plural,
+        }, context_instance=RequestContext(request))
+
+    
+class CheckpointAdmin(admin.ModelAdmin):
+    list_display = ['conduit', 'created', 'remaining']
+    exclude = ['keys']
+    readonly_fields = ['conduit', 'created', 'fingerprint', 'remaining']
+    order = 7
+
+
+class WorkerAdmin(admin.ModelAdmin):
+    list_display = ['hostname', 'pid', 'started', 'heartbeat', 'running', 'stopped']
+    readonly_fields = list_display
+    order = 8
+
+
+class LeaseAdmin(admin.ModelAdmin):
+    list_display = ['name', 'owner', 'acquired', 'expires']
+    readonly_fields = list_display
+    order = 9
+
     
 class ScheduleAdmin(admin.ModelAdmin):
     list_display = ['conduit_set', 'enabled', 'minute', 'hours', 'day_of_month', 'month', 'day_of_week', 'last_run', 'executing']
@@ -124,22 +190,39 @@ class ConduitAdmin(admin.ModelAdmin):
         (None, {
             'fields': ('name', 'master_db', 'slave_db', 'master_table', 'master_subset', 'slave_table', 'slave_subset', 'primary_key_source', 'detect_primary_key', 'key_fields', 'fields_to_fetch', 'dry_run')
         }),
+        (_(u'Incremental replication and checkpoints'), {
+            'classes': ('collapse-closed',),
+            'fields': ('incremental_column', 'high_water_mark', 'checkpoint_max_age')
+        }),
+        (_(u'Snapshot'), {
+            'classes': ('collapse-closed',),
+            'fields': ('snapshot',)
+        }),
+        (_(u'Updates and deletes'), {
+            'classes': ('collapse-closed',),
+            'fields': ('update_rows', 'update_chunk_size', 'delete_rows', 'delete_chunk_size', 'max_delete_percentage')
+        }),
         (_(u'Error handling'), {
             'classes': ('collapse-closed',),
             'fields': ('ignore_slave_modify_errors', 'slave_warnings_abort_threshold', 'ignore_master_pull_errors', 'master_warnings_abort_threshold')
         }),
         (_(u'Performance'), {
             'classes': ('collapse-closed',),
-            'fields': ('master_key_batchsize', 'slave_key_batchsize', 'batchsize')
+            'fields': ('master_key_batchsize', 'slave_key_batchsize', 'diff_strategy', 'diff_partitions', 'checksum_bucket_size', 'batchsize', 'fetch_chunk_size', 'insert_chunk_size', 'slave_writer', 'pipelined', 'pipeline_queue_depth')
         }),
         (_(u'Timeouts'), {
             'classes': ('collapse-closed',),
             'fields': ('timeout', 'major_timeout', 'minor_timeout')
         }),
+        (_(u'Cached metadata'), {
+            'classes': ('collapse-closed',),
+            'fields': ('metadata',)
+        }),
     )
+    readonly_fields = ('metadata',)
     order = 2	
     
-    actions = ['execute', 'clone']
+    actions = ['execute', 'clone', 'clear_metadata']
 
     def execute(self, request, queryset):
         for i in queryset:
@@ -163,6 +246,16 @@ class ConduitAdmin(admin.ModelAdmin):
         
     clone.short_description = _(u"Copy the selected object")	
 
+    def clear_metadata(self, request, queryset):
+        count = queryset.update(metadata=None)
+
+        if count == 1:
+            message_bit = _(u"1 conduit")
+        else:
+            message_bit = _(u"%s conduits") % count
+        self.message_user(request, _(u"Cached metadata cleared for %s; it will be detected again on the next execution.") % message_bit)
+    clear_metadata.short_description = _(u"Clear cached metadata")
+
 
 admin.site.register(Host, HostAdmin)
 admin.site.register(Database, DatabaseAdmin)
@@ -170,4 +263,8 @@ admin.site.register(Conduit, ConduitAdmin)
 admin.site.register(Conduit_Set, Conduit_SetAdmin)
 admin.site.register(Schedule, ScheduleAdmin)
 admin.site.register(Log, LogAdmin)
+admin.site.register(ConduitRun, ConduitRunAdmin)
+admin.site.register(Checkpoint, CheckpointAdmin)
+admin.site.register(Worker, WorkerAdmin)
+admin.site.register(Lease, LeaseAdmin)
 
@@ -0,0 +1,51 @@
+import zlib
+import base64
+import datetime
+
+from django.utils import simplejson
+
+from models import Checkpoint
+
+
+def pack_keys(keys):
+    return base64.b64encode(zlib.compress(simplejson.dumps([list(key) for key in keys])))
+
+
+def unpack_keys(data):
+    return [tuple(key) for key in simplejson.loads(zlib.decompress(base64.b64decode(data)))]
+
+
+def load_checkpoint(conduit, fingerprint):
+    """The keys left by a previous execution, None if there is no checkpoint,
+    it expired or the conduit settings changed since"""
+    try:
+        checkpoint = Checkpoint.objects.get(conduit=conduit)
+    except Checkpoint.DoesNotExist:
+        return
+
+    if checkpoint.fingerprint != fingerprint or datetime.datetime.now() - checkpoint.created > datetime.timedelta(seconds=conduit.checkpoint_max_age):
+        checkpoint.delete()
+        return
+    return checkpoint.created, unpack_keys(checkpoint.keys)
+
+
+def save_checkpoint(conduit, fingerprint, created, keys):
+    """Store the keys left to append; created is when they were compared"""
+    keys = list(keys)
+    if not keys:
+        clear_checkpoint(conduit)
+        return
+
+    try:
+        checkpoint = Checkpoint.objects.get(conduit=conduit)
+    except Checkpoint.DoesNotExist:
+        checkpoint = Checkpoint(conduit=conduit)
+    checkpoint.created = created
+    checkpoint.fingerprint = fingerprint
+    checkpoint.remaining = len(keys)
+    checkpoint.keys = pack_keys(keys)
+    checkpoint.save()
+
+
+def clear_checkpoint(conduit):
+    Checkpoint.objects.filter(conduit=conduit).delete()
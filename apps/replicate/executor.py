@@ -0,0 +1,299 @@
+import sys
+import time
+import signal
+import traceback
+import datetime
+import threading
+from collections import deque
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.db import connection as django_connection
+
+from models import Conduit, Schedule
+from utils import execute_timed_conduit, logger_ec, logger_es
+from leases import lease_owner, acquire_lease, renew_lease, release_lease, lease_held
+
+DEFAULT_REPLICATE_MAX_WORKERS = 4
+DEFAULT_REPLICATE_MAX_WORKERS_PER_HOST = 2
+DEFAULT_REPLICATE_LEASE_MARGIN = 60
+
+lease_margin = getattr(settings, "REPLICATE_LEASE_MARGIN", DEFAULT_REPLICATE_LEASE_MARGIN)
+
+
+def worker_init():
+    #The application database connection inherited from the parent can't be shared
+    django_connection.close()
+    #Interrupting the parent (replicate_worker) lets the running conduits finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_conduit(conduit_id):
+    """Worker process entry point, must never raise or the executor would
+    never learn that the conduit finished"""
+    try:
+        conduit = Conduit.objects.get(pk=conduit_id)
+        #Conduits can't run past their timeout, the lease outlives them
+        name = 'conduit:%d' % conduit.pk
+        owner = lease_owner()
+        if acquire_lease(name, owner, conduit.timeout + lease_margin):
+            try:
+                execute_timed_conduit(conduit)
+            finally:
+                release_lease(name, owner)
+        else:
+            logger_ec.warning(u'Conduit: %s; Already being executed by another worker, skipped.' % conduit)
+    except:
+        (exc_type, exc_info, tb) = sys.exc_info()
+        logger_ec.error(u'Conduit: %s; Error; %s' % (conduit_id, traceback.format_exception(exc_type, exc_info, None)[0]))
+    return conduit_id
+
+
+def conduit_hosts(conduit):
+    return set([conduit.master_db.host_id, conduit.slave_db.host_id])
+
+
+class Job(object):
+    """A group of conduits waiting to be executed, either all at once (concurrent)
+    or in order.  The lease (name, owner) of a job is renewed by the executor
+    until the job is done, queued or running"""
+    def __init__(self, name, conduits, concurrent, callback=None, lease=None):
+        self.name = name
+        self.pending = list(conduits)
+        self.concurrent = concurrent
+        self.callback = callback
+        self.lease = lease
+        self.running = 0
+
+    def candidates(self):
+        if self.concurrent:
+            return self.pending
+        elif self.running:
+            return []
+        return self.pending[:1]
+
+
+class Task(object):
+    """A conduit handed to the pool; a worker process that dies never reports
+    back, so the task is given up on past its deadline"""
+    def __init__(self, job, conduit, hosts):
+        self.job = job
+        self.conduit = conduit
+        self.hosts = hosts
+        #Conduits stop themselves at their timeout
+        self.deadline = time.time() + conduit.timeout + lease_margin
+        self.result = None
+
+
+class Executor(object):
+    """Runs conduits on a fixed size pool of long lived worker processes.
+    Jobs take turns (round robin) to start their next conduit, and a conduit
+    only starts if neither its master nor its slave host is already serving
+    [max_per_host] conduits"""
+    def __init__(self, max_workers, max_per_host):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.pool = None
+        self.jobs = deque()
+        self.running = 0
+        self.running_hosts = {}
+        self.tasks = []
+        self.condition = threading.Condition()
+        self.dispatcher = None
+        self.stopping = False
+        self.renewal = 0
+
+    def submit(self, job):
+        self.condition.acquire()
+        try:
+            if self.stopping:
+                logger_es.warning(u"Shutting down, %s was not executed." % job.name)
+                return
+            if self.pool is None:
+                self.pool = Pool(self.max_workers, worker_init)
+                self.dispatcher = threading.Thread(target=self.dispatch)
+                self.dispatcher.setDaemon(True)
+                self.dispatcher.start()
+            self.jobs.append(job)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def host_available(self, hosts):
+        for host in hosts:
+            if self.running_hosts.get(host, 0) >= self.max_per_host:
+                return False
+        return True
+
+    def start_next(self):
+        """Start one conduit if there is a free worker for it, returns whether one was started"""
+        if self.stopping or self.running >= self.max_workers:
+            return False
+
+        for i in range(len(self.jobs)):
+            job = self.jobs[0]
+            self.jobs.rotate(-1)
+            for conduit in job.candidates():
+                hosts = conduit_hosts(conduit)
+                if self.host_available(hosts):
+                    job.pending.remove(conduit)
+                    job.running += 1
+                    self.running += 1
+                    for host in hosts:
+                        self.running_hosts[host] = self.running_hosts.get(host, 0) + 1
+                    task = Task(job, conduit, hosts)
+                    self.tasks.append(task)
+                    task.result = self.pool.apply_async(run_conduit, (conduit.pk,), callback=lambda result, task=task: self.finished(task))
+                    return True
+        return False
+
+    def expire_tasks(self):
+        """Fail the tasks past their deadline, their worker process died (or
+        hung) without reporting back; returns the time of the next deadline"""
+        now = time.time()
+        for task in list(self.tasks):
+            if task.deadline <= now and not task.result.ready():
+                logger_ec.error(u'Conduit: %s; The worker process did not report back before the conduit timeout, giving up on it.' % task.conduit)
+                self.condition.release()
+                try:
+                    self.finished(task)
+                finally:
+                    self.condition.acquire()
+        return min([task.deadline for task in self.tasks] or [None])
+
+    def renew_leases(self):
+        leases = [(job.name, job.lease) for job in self.jobs if job.lease]
+        self.condition.release()
+        try:
+            for job_name, (name, owner) in leases:
+                try:
+                    if not renew_lease(name, owner, lease_margin):
+                        logger_es.warning(u"%s; Lease %s was lost." % (job_name, name))
+                except:
+                    logger_es.warning(u"%s; Lease %s renewal error; %s" % (job_name, name, sys.exc_info()[1]))
+        finally:
+            self.condition.acquire()
+        self.renewal = time.time() + lease_margin / 3.0
+
+    def dispatch(self):
+        self.condition.acquire()
+        try:
+            while True:
+                if time.time() >= self.renewal:
+                    self.renew_leases()
+                deadline = self.expire_tasks()
+                if not self.start_next():
+                    self.condition.wait(max(min(self.renewal, deadline or self.renewal) - time.time(), 0))
+        finally:
+            self.condition.release()
+
+    def finished(self, task):
+        self.condition.acquire()
+        try:
+            if task not in self.tasks:
+                #Already given up on
+                return
+            self.tasks.remove(task)
+            job = task.job
+            job.running -= 1
+            self.running -= 1
+            for host in task.hosts:
+                self.running_hosts[host] -= 1
+            done = not job.pending and not job.running
+            if done:
+                self.jobs.remove(job)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+        if done and job.callback:
+            job.callback()
+
+    def shutdown(self, timeout):
+        """Stop starting conduits and wait up to timeout seconds for the running
+        ones to finish; those still running after that are terminated.  Returns
+        whether all of them finished"""
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            deadline = time.time() + timeout
+            while self.running and deadline > time.time():
+                self.condition.wait(deadline - time.time())
+            finished = not self.running
+            pool = self.pool
+        finally:
+            self.condition.release()
+
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                logger_es.warning(u"Terminating %d running conduits." % self.running)
+                pool.terminate()
+            pool.join()
+        return finished
+
+
+executor = Executor(
+    getattr(settings, "REPLICATE_MAX_WORKERS", DEFAULT_REPLICATE_MAX_WORKERS),
+    getattr(settings, "REPLICATE_MAX_WORKERS_PER_HOST", DEFAULT_REPLICATE_MAX_WORKERS_PER_HOST))
+
+
+def execute_conduit_manually(conduit):
+    """Helper view to manually execute a conduit"""
+    logger_ec.info(u'Conduit: %s; Manually executing conduit...' % conduit)
+    executor.submit(Job(unicode(conduit), [conduit], False))
+
+
+def execute_conduit_set(conduit_set, callback=None, lease=None):
+    """Queue the conduits of a conduit set for execution, callback is called once all of them finished"""
+    logger_es.info(u"Executing conduit_set: %s." % conduit_set)
+
+    def finished():
+        logger_es.info(u"Finished executing conduit_set: %s." % conduit_set)
+        if callback:
+            callback()
+
+    conduits = list(conduit_set.conduits.all())
+    if conduits:
+        executor.submit(Job(unicode(conduit_set), conduits, conduit_set.concurrent, finished, lease))
+    else:
+        finished()
+
+
+def schedule_lease_name(schedule):
+    return 'schedule:%d' % schedule.pk
+
+
+def execute_schedule(schedule, fire_time=None):
+    """Execute a schedule, calling the associated conduit_set, unless it is
+    already being executed by this or another node; returns whether it was"""
+    name = schedule_lease_name(schedule)
+    owner = lease_owner()
+    #Renewed by the executor while the conduits are queued or running, so it
+    #only expires [lease margin] seconds after the node dies
+    if not acquire_lease(name, owner, lease_margin):
+        logger_es.info(u"Schedule: %s; Already executing, skipped." % schedule)
+        return False
+
+    logger_es.info(u"Schedule: %s; Started." % schedule)
+
+    schedule.executing = True
+    Schedule.objects.filter(pk=schedule.pk).update(executing=True)
+
+    def finished():
+        logger_es.info(u"Schedule: %s; Finished." % schedule)
+        Schedule.objects.filter(pk=schedule.pk).update(last_run=datetime.datetime.now(), executing=False)
+        #Nodes whose clocks are a bit late must not fire it again for the same minute
+        release_lease(name, owner, fire_time and fire_time + datetime.timedelta(minutes=1))
+
+    execute_conduit_set(schedule.conduit_set, finished, (name, owner))
+    return True
+
+
+def reset_executing_schedules():
+    """Clear the executing flag of the schedules nobody holds a lease for,
+    left behind by a node that crashed or was stopped"""
+    for schedule in Schedule.objects.filter(executing=True):
+        if not lease_held(schedule_lease_name(schedule)):
+            Schedule.objects.filter(pk=schedule.pk).update(executing=False)
@@ -0,0 +1,81 @@
+import marshal
+from array import array
+
+from django.utils.encoding import smart_unicode
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def pack_key(key):
+    return marshal.dumps(tuple(map(smart_unicode, key)))
+
+
+class KeyList(object):
+    """Keys resulting from comparing two CompactKeys, unpacked into tuples of
+    unicode (the form the rest of the conduit works with) while iterating"""
+    def __init__(self, keys, packed):
+        self.keys = keys
+        self.packed = packed
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        if self.packed:
+            for key in self.keys:
+                yield marshal.loads(key)
+        else:
+            for key in self.keys:
+                yield (unicode(key),)
+
+
+class CompactKeys(object):
+    """The keys returned by a key query.  Single column integer keys (declared
+    numeric by the driver, or of unknown type, and only holding integers) are
+    kept in an array of machine integers, 8 bytes per key; any other key is
+    marshalled into a single string instead of a tuple of unicode objects"""
+    def __init__(self, description, number_type=None):
+        self.packed = set()
+        self.integers = None
+        if len(description) == 1 and (description[0][1] is None or (number_type is not None and number_type == description[0][1])):
+            self.integers = array('l')
+
+    def add(self, keys):
+        for key in keys:
+            if self.integers is not None:
+                if type(key[0]) in (int, long):
+                    try:
+                        self.integers.append(key[0])
+                        continue
+                    except OverflowError:
+                        pass
+                self.pack()
+            self.packed.add(pack_key(key))
+
+    def pack(self):
+        """Give up on the integer representation"""
+        if self.integers is not None:
+            self.packed.update([pack_key((key,)) for key in self.integers])
+            self.integers = None
+
+    def __len__(self):
+        if self.integers is not None:
+            return len(self.integers)
+        return len(self.packed)
+
+    def difference(self, other):
+        """KeyList of the keys not in other"""
+        if self.integers is not None and other.integers is not None:
+            if numpy is not None and self.integers and other.integers:
+                return KeyList(numpy.setdiff1d(numpy.frombuffer(self.integers, dtype='l'), numpy.frombuffer(other.integers, dtype='l')), False)
+            if not other.integers:
+                return KeyList(self.integers, False)
+            other_keys = set(other.integers)
+            return KeyList(array('l', [key for key in self.integers if key not in other_keys]), False)
+
+        self.pack()
+        other.pack()
+        return KeyList(list(self.packed.difference(other.packed)), True)
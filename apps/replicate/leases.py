@@ -0,0 +1,53 @@
+import os
+import uuid
+import socket
+import datetime
+
+from django.db import transaction, IntegrityError
+
+from models import Lease
+
+
+def lease_owner():
+    """Host, process id and a token unique to each claim, so a lease can only
+    be renewed or released by the run that acquired it"""
+    return "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def acquire_lease(name, owner, seconds):
+    """Claim name for seconds, returns whether it was claimed.  A lease that
+    hasn't expired can't be claimed again, not even by the same process.  The
+    claim is a single conditional UPDATE (or an INSERT checked by the unique
+    name), so only one of the nodes racing for a lease gets it; leases past
+    their expiry are taken over.  Node clocks are expected to be in sync"""
+    now = datetime.datetime.now()
+    expires = now + datetime.timedelta(seconds=seconds)
+    if Lease.objects.filter(name=name, expires__lte=now).update(owner=owner, acquired=now, expires=expires):
+        return True
+
+    try:
+        Lease.objects.create(name=name, owner=owner, acquired=now, expires=expires)
+        return True
+    except IntegrityError:
+        #Someone else holds it
+        transaction.rollback_unless_managed()
+        return False
+
+
+def renew_lease(name, owner, seconds):
+    """Extend a lease still held by owner, returns whether it was"""
+    expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    return Lease.objects.filter(name=name, owner=owner).update(expires=expires) > 0
+
+
+def release_lease(name, owner, keep_until=None):
+    """Give up a lease, or keep it until keep_until"""
+    leases = Lease.objects.filter(name=name, owner=owner)
+    if keep_until and keep_until > datetime.datetime.now():
+        leases.update(expires=keep_until)
+    else:
+        leases.delete()
+
+
+def lease_held(name):
+    return Lease.objects.filter(name=name, expires__gt=datetime.datetime.now()).count() > 0
@@ -0,0 +1,221 @@
+import os
+import sys
+import random
+import shutil
+import sqlite3
+import tempfile
+import resource
+from Queue import Empty
+from hashlib import md5
+from optparse import make_option
+from multiprocessing import Process, Queue
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection as django_connection
+from django.utils import simplejson
+
+from replicate.models import Host, Database, Conduit, ConduitRun
+from replicate.utils import execute_conduit
+
+KEY_SHAPES = {
+    'int': ('id INTEGER PRIMARY KEY', lambda i: (i,)),
+    'composite': ('region INTEGER, id INTEGER', lambda i: (i % 16, i)),
+    'string': ('code VARCHAR(40) PRIMARY KEY', lambda i: ('key-%s' % md5(str(i)).hexdigest(),)),
+}
+
+TABLE = 'benchmark'
+
+
+def create_table(filename, key):
+    columns = KEY_SHAPES[key][0] + ', name VARCHAR(64), quantity INTEGER, amount REAL, created TIMESTAMP'
+    if key == 'composite':
+        #Table constraints follow the column definitions
+        columns += ', PRIMARY KEY (region, id)'
+    connection = sqlite3.connect(filename)
+    connection.execute("CREATE TABLE %s (%s)" % (TABLE, columns))
+    return connection
+
+
+def generate_fixtures(directory, rows, key, divergence, seed):
+    """Master and slave SQLite databases holding the same rows, except for a
+    [divergence] fraction of them only found on the master; returns the
+    amount of missing slave rows"""
+    rng = random.Random(seed)
+    key_values = KEY_SHAPES[key][1]
+    master = create_table(os.path.join(directory, 'master.db'), key)
+    slave = create_table(os.path.join(directory, 'slave.db'), key)
+    placeholders = ', '.join(['?'] * (len(key_values(0)) + 4))
+    missing = 0
+    for start in range(0, rows, 10000):
+        master_rows = []
+        slave_rows = []
+        for i in range(start, min(start + 10000, rows)):
+            row = key_values(i) + (u'row %d %s' % (i, u'x' * rng.randint(0, 32)), rng.randint(0, 1000000), rng.random() * 1000, '2010-01-01 %02d:%02d:%02d' % (i / 3600 % 24, i / 60 % 60, i % 60))
+            master_rows.append(row)
+            if rng.random() < divergence:
+                missing += 1
+            else:
+                slave_rows.append(row)
+        master.executemany("INSERT INTO %s VALUES(%s)" % (TABLE, placeholders), master_rows)
+        slave.executemany("INSERT INTO %s VALUES(%s)" % (TABLE, placeholders), slave_rows)
+    for connection in (master, slave):
+        connection.commit()
+        connection.close()
+    return missing
+
+
+def count_rows(filename):
+    connection = sqlite3.connect(filename)
+    try:
+        return connection.execute("SELECT COUNT(*) FROM %s" % TABLE).fetchone()[0]
+    finally:
+        connection.close()
+
+
+def peak_rss():
+    """Peak resident set size of this process, in kilobytes"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        #Bytes instead of kilobytes
+        maxrss /= 1024
+    return maxrss
+
+
+def run_case(conduit_id, slave_filename, results):
+    """Child process entry point, each execution gets a fresh process so its
+    peak RSS is its own"""
+    try:
+        #The application database connection inherited from the parent can't be shared
+        django_connection.close()
+        conduit = Conduit.objects.get(pk=conduit_id)
+        error = execute_conduit(conduit)
+        run = ConduitRun.objects.filter(conduit=conduit).order_by('-started')[0]
+        result = {
+            'status': run.status,
+            'phases': dict([(phase, getattr(run, '%s_time' % phase)) for phase in ConduitRun.PHASES]),
+            'total_time': run.total_time,
+            'master_keys': run.master_keys,
+            'slave_keys': run.slave_keys,
+            'rows_appended': run.rows_appended,
+            'rows_per_second': run.rows_per_second,
+            'bytes_transferred': run.bytes_transferred,
+            'peak_rss_kb': peak_rss(),
+            'slave_rows': count_rows(slave_filename),
+        }
+        if error:
+            result['error'] = ''.join(error).strip()
+    except:
+        result = {'status': 'F', 'error': unicode(sys.exc_info()[1])}
+    results.put(result)
+
+
+def split_option(value):
+    return [item.strip() for item in value.split(',')]
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', dest='rows', default=10000,
+            help='Amount of master rows.'),
+        make_option('--key', dest='key', default='int',
+            help='Primary key shape: int, composite (two integers) or string.'),
+        make_option('--divergence', type='float', dest='divergence', default=0.1,
+            help='Fraction of the master rows missing from the slave.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Random seed of the generated rows.'),
+        make_option('--strategies', dest='strategies', default='set,merge,checksum',
+            help='Comma separated key comparison strategies to run.'),
+        make_option('--chunk-sizes', dest='chunk_sizes', default='100',
+            help='Comma separated master fetch and slave insert chunk sizes to run.'),
+        make_option('--slave-writers', dest='slave_writers', default='',
+            help='Comma separated slave writers to run, empty for the automatic one.'),
+        make_option('--pipelined', action='store_true', dest='pipelined', default=False,
+            help='Pipeline the row transfer.'),
+        make_option('--repeat', type='int', dest='repeat', default=1,
+            help='Executions of each combination.'),
+        make_option('--output', dest='output', default=None,
+            help='Write the JSON report to this file instead of the standard output.'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+            help='Keep the generated databases.'),
+    )
+    help = 'Replicate synthetic SQLite master/slave databases end to end and report the timings of each phase as JSON.'
+
+    def handle(self, *args, **options):
+        if options['key'] not in KEY_SHAPES:
+            raise CommandError('Unknown key shape: %s' % options['key'])
+        strategies = split_option(options['strategies'])
+        for strategy in strategies:
+            if strategy not in dict(Conduit.DIFF_STRATEGY_CHOICES):
+                raise CommandError('Unknown key comparison strategy: %s' % strategy)
+        try:
+            chunk_sizes = [int(size) for size in split_option(options['chunk_sizes'])]
+        except ValueError:
+            raise CommandError('Invalid chunk sizes: %s' % options['chunk_sizes'])
+        slave_writers = split_option(options['slave_writers'])
+
+        #Database names are limited to 32 characters
+        directory = tempfile.mkdtemp(prefix='rb')
+        host = Host.objects.create(name='benchmark', ip_address='127.0.0.1')
+        try:
+            pristine = os.path.join(directory, 'pristine')
+            os.mkdir(pristine)
+            missing = generate_fixtures(pristine, options['rows'], options['key'], options['divergence'], options['seed'])
+            master_filename = os.path.join(directory, 'master.db')
+            slave_filename = os.path.join(directory, 'slave.db')
+            master_db = Database.objects.create(host=host, backend='sqlite3', name=master_filename)
+            slave_db = Database.objects.create(host=host, backend='sqlite3', name=slave_filename)
+
+            report = {
+                'fixture': {
+                    'rows': options['rows'],
+                    'key': options['key'],
+                    'divergence': options['divergence'],
+                    'seed': options['seed'],
+                    'missing_rows': missing,
+                },
+                'runs': [],
+            }
+            for strategy in strategies:
+                for chunk_size in chunk_sizes:
+                    for slave_writer in slave_writers:
+                        conduit = Conduit.objects.create(name='benchmark', master_db=master_db, slave_db=slave_db,
+                            master_table=TABLE, slave_table=TABLE, diff_strategy=strategy,
+                            batchsize=options['rows'], fetch_chunk_size=chunk_size, insert_chunk_size=chunk_size,
+                            slave_writer=slave_writer or None, pipelined=options['pipelined'],
+                            checkpoint_max_age=0, dry_run=False, timeout=86400, major_timeout=86400)
+                        for repeat in range(options['repeat']):
+                            for filename in ('master.db', 'slave.db'):
+                                shutil.copy(os.path.join(pristine, filename), os.path.join(directory, filename))
+                            results = Queue()
+                            process = Process(target=run_case, args=(conduit.pk, slave_filename, results))
+                            process.start()
+                            while True:
+                                try:
+                                    result = results.get(True, 1)
+                                    break
+                                except Empty:
+                                    if not process.is_alive():
+                                        result = {'status': 'F', 'error': 'benchmark process exit code %s' % process.exitcode}
+                                        break
+                            process.join()
+
+                            result.update({
+                                'diff_strategy': strategy,
+                                'chunk_size': chunk_size,
+                                'slave_writer': slave_writer or 'automatic',
+                                'pipelined': options['pipelined'],
+                                'repeat': repeat,
+                            })
+                            result['verified'] = result.get('slave_rows') == options['rows']
+                            report['runs'].append(result)
+        finally:
+            #Cascades to the databases, conduits and their runs
+            host.delete()
+            if not options['keep']:
+                shutil.rmtree(directory, True)
+
+        output = simplejson.dumps(report, indent=2)
+        if options['output']:
+            open(options['output'], 'w').write(output)
+        else:
+            print output
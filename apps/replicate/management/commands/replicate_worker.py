@@ -0,0 +1,64 @@
+import os
+import socket
+import signal
+import datetime
+import threading
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.utils import DatabaseError
+
+from replicate import start_scheduler
+from replicate.models import Worker
+from replicate.scheduler import scheduler
+from replicate.executor import executor
+from replicate.pool import connection_pool
+from replicate.utils import logger_es
+
+DEFAULT_REPLICATE_WORKER_HEARTBEAT = 30
+DEFAULT_REPLICATE_WORKER_SHUTDOWN_TIMEOUT = 300
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--heartbeat', type='int', dest='heartbeat',
+            default=getattr(settings, "REPLICATE_WORKER_HEARTBEAT", DEFAULT_REPLICATE_WORKER_HEARTBEAT),
+            help='Seconds between heartbeats.'),
+        make_option('--shutdown-timeout', type='int', dest='shutdown_timeout',
+            default=getattr(settings, "REPLICATE_WORKER_SHUTDOWN_TIMEOUT", DEFAULT_REPLICATE_WORKER_SHUTDOWN_TIMEOUT),
+            help='Seconds to wait for the running conduits when stopping before terminating them.'),
+    )
+    help = 'Run the schedules in this process until interrupted (SIGINT or SIGTERM); set REPLICATE_AUTOSTART_SCHEDULER = False so web processes leave them to it.'
+
+    def handle(self, *args, **options):
+        try:
+            start_scheduler()
+        except socket.error:
+            raise CommandError('The scheduler is already running on this host (REPLICATE_SAFETY_PORT is in use).')
+
+        stop = threading.Event()
+
+        def interrupted(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGINT, interrupted)
+        signal.signal(signal.SIGTERM, interrupted)
+
+        now = datetime.datetime.now()
+        worker = Worker.objects.create(hostname=socket.gethostname(), pid=os.getpid(), started=now, heartbeat=now)
+        logger_es.info(u"Worker: %s; Started." % worker)
+
+        while not stop.isSet():
+            stop.wait(options['heartbeat'])
+            try:
+                Worker.objects.filter(pk=worker.pk).update(heartbeat=datetime.datetime.now(), running=executor.running)
+            except DatabaseError, e:
+                logger_es.warning(u"Worker: %s; Heartbeat error; %s" % (worker, e))
+
+        logger_es.info(u"Worker: %s; Stopping, waiting for %d running conduits." % (worker, executor.running))
+        scheduler.stop(options['heartbeat'])
+        finished = executor.shutdown(options['shutdown_timeout'])
+        connection_pool.close_all()
+        Worker.objects.filter(pk=worker.pk).update(heartbeat=datetime.datetime.now(), running=0, stopped=datetime.datetime.now())
+        logger_es.info(u"Worker: %s; Stopped%s." % (worker, not finished and u', running conduits were terminated' or u''))
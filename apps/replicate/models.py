@@ -75,12 +75,35 @@ class Conduit(models.Model):
         ('S', _(u'Slave')),
     )
     primary_key_source = models.CharField(max_length=1, default='M', choices=PKSRC_CHOICES, verbose_name=_(u'primary key source'), help_text = _(u"Determines which database (master or slave) is going to be queried to determine the primary key."))
-    detect_primary_key = models.BooleanField(default=True, help_text=_(u'Only works for MySQL databases so far.'), verbose_name = _(u"detect primary key"))
+    detect_primary_key = models.BooleanField(default=True, help_text=_(u'Supported for MySQL, PostgreSQL, Oracle, SQL Server and SQLite.  Tables without a primary key use their unique index with the fewest columns.'), verbose_name = _(u"detect primary key"))
     key_fields = models.TextField(blank=True, null=True, help_text=_(u'Comma separated list of fields that compose a primary key.'), verbose_name = _(u"key fields"))
+    incremental_column = models.CharField(max_length=64, blank=True, null=True, help_text=_(u'Monotonically increasing master column (auto increment id, creation timestamp).  If specified only rows at or beyond the last replicated value of this column are compared on each execution; rows where it is empty are ignored.  The column must also exist on the slave table.'), verbose_name=_(u"incremental column"))
+    high_water_mark = models.CharField(max_length=64, blank=True, null=True, help_text=_(u'Last value of the incremental column replicated by this conduit.  Clear it to force a full comparison on the next execution.'), verbose_name=_(u"high water mark"))
     master_key_batchsize = models.PositiveIntegerField(default=1000, help_text=_(u'Size of keys block to fetch from master when comparing master/slave difference (optimization value affected by: network speed/latency, computer memory amount).  Use 0 to disable this feature and fetch all keys in one request.'), verbose_name = _(u"master key fetch buffer size"))
     slave_key_batchsize = models.PositiveIntegerField(default=1000, help_text=_(u'Size of keys block to fetch from slave when comparing master/slave difference (optimization value affected by: network speed/latency, computer memory amount).  Use 0 to disable this feature and fetch all keys in one request.'), verbose_name = _(u"slave key fetch buffer size"))
+    DIFF_STRATEGY_CHOICES = (
+        ('set', _(u'In memory set difference')),
+        ('merge', _(u'Sorted merge (streaming)')),
+        ('checksum', _(u'Bucket checksums')),
+    )
+    diff_strategy = models.CharField(max_length=16, default='set', choices=DIFF_STRATEGY_CHOICES, help_text=_(u'How master and slave keys are compared.  "Sorted merge" fetches both key sets ordered by the primary key and compares them while streaming, keeping memory usage bounded by the key fetch buffer sizes; it requires the database ordering of the key columns to match a plain binary/numeric ordering.  "Bucket checksums" compares key counts and hashes per range of the first (numeric) key column, computed inside the databases, and only fetches the keys of the ranges that differ; both databases must be of the same kind, otherwise the keys are compared with the in memory set difference.'), verbose_name=_(u"key comparison strategy"))
+    diff_partitions = models.PositiveIntegerField(default=1, help_text=_(u'Split the key space into this many ranges of the first (numeric) key column, between its lowest and highest value on both databases, and compare the keys of each range in parallel, each one over its own master and slave connections.  Only used by the in memory set difference strategy; every range needs a free connection slot on both hosts.  Use 1 to compare all the keys at once.'), verbose_name=_(u"key comparison partitions"))
+    checksum_bucket_size = models.PositiveIntegerField(default=10000, help_text=_(u'Range of values of the first key column covered by each bucket when comparing keys with bucket checksums.'), verbose_name=_(u"checksum bucket size"))
     batchsize = models.PositiveIntegerField(default=1000, help_text=_(u'Amount of records to append per conduit execution (this value is independant of [master_key_buffersize] value.'), verbose_name=_(u"conduit batchsize"))
+    fetch_chunk_size = models.PositiveIntegerField(default=100, help_text=_(u'Amount of rows to fetch from master with a single query when appending rows (optimization value affected by: network latency, query size limits; ORACLE allows at most 1000 values per IN list).  Use 1 to fetch rows one by one.'), verbose_name=_(u"master row fetch chunk size"))
+    insert_chunk_size = models.PositiveIntegerField(default=100, help_text=_(u'Amount of rows inserted into the slave with a single bulk statement and transaction.  Chunks that fail are retried row by row.  Use 1 to insert (and commit) rows one by one.'), verbose_name=_(u"slave insert chunk size"))
+    pipelined = models.BooleanField(default=False, help_text=_(u'Fetch rows from master in a separate thread while the previous chunks are being inserted into the slave, overlapping the network latency of both databases.'), verbose_name=_(u"pipelined row transfer"))
+    SLAVE_WRITER_CHOICES = (
+        ('insert', _(u'INSERT statements')),
+        ('copy', _(u'PostgreSQL COPY')),
+        ('load_data', _(u'MySQL LOAD DATA LOCAL INFILE')),
+        ('sqlite', _(u'SQLite single transaction')),
+    )
+    slave_writer = models.CharField(max_length=16, blank=True, null=True, choices=SLAVE_WRITER_CHOICES, help_text=_(u'How chunks of rows are appended to the slave.  Leave empty to use the fastest loader of the slave backend: COPY FROM STDIN for PostgreSQL (psycopg2), LOAD DATA LOCAL INFILE for MySQL (unless the REPLICATE_MYSQL_LOCAL_INFILE setting is off, local_infile must be enabled on the server), the whole load in a single transaction without synchronous writes for SQLite and INSERT statements for the rest.  Chunks that fail to load are still inserted row by row.'), verbose_name=_(u"slave writer"))
+    pipeline_queue_depth = models.PositiveIntegerField(default=4, help_text=_(u'Maximum amount of fetched row chunks (of [fetch_chunk_size] rows each) waiting to be inserted when the row transfer is pipelined.'), verbose_name=_(u"pipeline queue depth"))
     fields_to_fetch = models.TextField(blank=True, null=True, help_text=_(u'Comma separated list of fields that will be replicated, if not specified all fields will be used.'), verbose_name=_(u"field to fetch"))
+    checkpoint_max_age = models.PositiveIntegerField(default=0, help_text=_(u'When an execution stops before appending all the missing rows (timeout, error or conduit batchsize reached) the keys left are saved, and the next executions append them without comparing the keys again until they are all done or this many seconds passed since the comparison; rows added to master meanwhile wait until then.  Keys appended by someone else in the meantime produce slave errors.  Checkpoints are discarded when the metadata detected again differs.  Not used by incremental conduits, dry runs or the sorted merge strategy.  0 (the default) always compares the keys.'), verbose_name=_(u"checkpoint maximum age"))
+    metadata = models.TextField(blank=True, null=True, help_text=_(u'Primary key columns, column list and statement templates detected on the last execution, reused while the conduit settings they depend on are unchanged.  The tables are not checked again: the metadata is cleared when an execution using it fails (ie: a column was added to the slave table); use the "Clear cached metadata" action after changing a table.'), verbose_name=_(u"cached metadata"))
     dry_run = models.BooleanField(default=True, help_text=_(u"Don't actually modify any data only log messages"), verbose_name=_(u"dry run"))
     ignore_slave_modify_errors = models.BooleanField(default=False, help_text=_(u'Ignore situations where a single slave append query returns an error (typical of incorrect primary key fields)'), verbose_name=_(u"ignore slave modify error"))
     slave_warnings_abort_threshold = models.PositiveIntegerField(default=0, help_text=_(u"Abort conduit after this many slave warnings.  A value of zero disables this function."), verbose_name=_(u"slave warnings abort threshold"))
@@ -98,19 +121,21 @@ class Conduit(models.Model):
     
 
     #DELETES
-    #allow_slave_deletes = models.BooleanField(default=False, verbose_name=_(u'allow slave deletes'), help_text=_(u'Delete rows on the slave database not found on the master database.')
+    delete_rows = models.BooleanField(default=False, help_text=_(u'Delete the slave rows whose keys are not found on the master.  Not supported by incremental conduits, which only compare the most recent keys.'), verbose_name=_(u'delete slave rows'))
+    delete_chunk_size = models.PositiveIntegerField(default=100, help_text=_(u'Amount of slave rows deleted with a single statement and transaction.'), verbose_name=_(u"slave delete chunk size"))
+    max_delete_percentage = models.PositiveIntegerField(default=10, help_text=_(u'Abort the conduit instead of deleting if more than this percentage of the slave rows (within the slave subset) would be deleted; protects the slave against a wrong master subset or an emptied master table.  Use 100 to disable this check.'), verbose_name=_(u"maximum delete percentage"))
     
     #UPDATES
-    #fields to compare (between master & slave & operation) to determine a update_set
-    #		- TextField => dict()
-    #		- { 'update_date', 'branch_update_date', '>' }
-    #		- provide %(last_replication_date)s == last date this conduit's update completed ok
-    #		- provide %(last_replication_time)s == last date this conduit's update completed ok
-    #		- provide %(last_replication_timestamp)s == last date this conduit's update completed ok
+    update_rows = models.BooleanField(default=False, help_text=_(u'After appending, compare the rows found on both master and slave and update the slave rows that differ.  Rows are compared through a hash of the fetched fields computed by the databases (MD5 for MySQL and PostgreSQL, ORA_HASH for Oracle, BINARY_CHECKSUM for MSSQL) when both are of the same kind, otherwise the rows are transferred and hashed here.  The slave columns must be named like the master ones.  At most [conduit batchsize] rows are updated per execution.'), verbose_name=_(u"update changed rows"))
+    update_chunk_size = models.PositiveIntegerField(default=100, help_text=_(u'Amount of rows updated on the slave with a single bulk statement and transaction.'), verbose_name=_(u"slave update chunk size"))
     
     #FULL update/snapshots
-    # test = models.TextField()
-    # expected_result = models.TextField()  in format = <  ['5','2']  > == single row or < [['43','34']['123','123]] == multirow
+    SNAPSHOT_CHOICES = (
+        ('A', _(u'Append all master rows')),
+        ('T', _(u'Empty the slave table first')),
+        ('S', _(u'Load a staging table and swap')),
+    )
+    snapshot = models.CharField(max_length=1, blank=True, null=True, choices=SNAPSHOT_CHOICES, help_text=_(u'Copy every master row (within the master subset) instead of comparing keys, streaming them through a server side cursor into bulk slave inserts of [slave insert chunk size] rows; meant for initial loads.  The slave table can be emptied first, or a staging table (named after the slave table with a "_staging" suffix, created like it) can be loaded and then renamed into its place, keeping the old rows available until the load completes.  Leave empty to compare keys.'), verbose_name=_(u"snapshot"))
 
     def __unicode__(self):
         return self.name
@@ -134,6 +159,66 @@ class Conduit(models.Model):
         verbose_name = _(u"conduit")
         verbose_name_plural = _(u"conduits")		
 
+
+class ConduitRun(models.Model):
+    conduit = models.ForeignKey(Conduit, verbose_name=_(u"conduit"))
+    STATUS_CHOICES = (
+        ('R', _(u'Running')),
+        ('S', _(u'Succeeded')),
+        ('F', _(u'Failed')),
+        ('T', _(u'Timed out')),
+    )
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, verbose_name=_(u"status"))
+    started = models.DateTimeField(verbose_name=_(u"started"))
+    finished = models.DateTimeField(blank=True, null=True, verbose_name=_(u"finished"))
+    total_time = models.FloatField(default=0, verbose_name=_(u"total time"))
+    connect_time = models.FloatField(default=0, verbose_name=_(u"connect time"))
+    primary_key_time = models.FloatField(default=0, verbose_name=_(u"primary key detection time"))
+    assemble_time = models.FloatField(default=0, verbose_name=_(u"query assembly time"))
+    master_keys_time = models.FloatField(default=0, verbose_name=_(u"master key fetch time"))
+    slave_keys_time = models.FloatField(default=0, verbose_name=_(u"slave key fetch time"))
+    diff_time = models.FloatField(default=0, verbose_name=_(u"key comparison time"))
+    row_fetch_time = models.FloatField(default=0, verbose_name=_(u"row fetch time"))
+    insert_time = models.FloatField(default=0, verbose_name=_(u"insert time"))
+    update_time = models.FloatField(default=0, help_text=_(u'Time spent fetching the changed rows from master and updating them on the slave; row hashes are accounted to the key fetch and comparison phases.'), verbose_name=_(u"update time"))
+    delete_time = models.FloatField(default=0, verbose_name=_(u"delete time"))
+    master_keys = models.PositiveIntegerField(default=0, verbose_name=_(u"master keys"))
+    slave_keys = models.PositiveIntegerField(default=0, verbose_name=_(u"slave keys"))
+    rows_appended = models.PositiveIntegerField(default=0, verbose_name=_(u"rows appended"))
+    rows_updated = models.PositiveIntegerField(default=0, verbose_name=_(u"rows updated"))
+    rows_deleted = models.PositiveIntegerField(default=0, verbose_name=_(u"rows deleted"))
+    rows_per_second = models.FloatField(default=0, verbose_name=_(u"rows/s"))
+    bytes_transferred = models.BigIntegerField(default=0, help_text=_(u'Approximate size of the row data fetched from master.'), verbose_name=_(u"bytes transferred"))
+
+    PHASES = ('connect', 'primary_key', 'assemble', 'master_keys', 'slave_keys', 'diff', 'row_fetch', 'insert', 'update', 'delete')
+
+    def __unicode__(self):
+        return "%s @ %s" % (self.conduit, self.started)
+
+    def phase_times(self):
+        return [(self._meta.get_field('%s_time' % phase).verbose_name, getattr(self, '%s_time' % phase)) for phase in self.PHASES]
+
+    class Meta:
+        ordering = ('-started',)
+        verbose_name = _(u"conduit run")
+        verbose_name_plural = _(u"conduit runs")
+
+
+class Checkpoint(models.Model):
+    conduit = models.OneToOneField(Conduit, verbose_name=_(u"conduit"))
+    created = models.DateTimeField(help_text=_(u'When the keys were compared.'), verbose_name=_(u"created"))
+    fingerprint = models.CharField(max_length=32, verbose_name=_(u"fingerprint"))
+    remaining = models.PositiveIntegerField(verbose_name=_(u"remaining keys"))
+    keys = models.TextField(help_text=_(u'Remaining keys, JSON compressed with zlib and base64 encoded.'), verbose_name=_(u"keys"))
+
+    def __unicode__(self):
+        return "%s @ %s" % (self.conduit, self.created)
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = _(u"checkpoint")
+        verbose_name_plural = _(u"checkpoints")
+
     
 class Log(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True, verbose_name=_(u"timestamp"))
@@ -177,13 +262,14 @@ class Schedule(models.Model):
     #TODO: Research schedule & Conduit_set may be merged?
     conduit_set = models.ForeignKey(Conduit_Set, verbose_name=_(u"conduit set"), help_text=_(u'Select which conduit set to schedule.'))
     enabled = models.BooleanField(default=True, verbose_name=_(u"enabled"))
-    minute = models.CharField(max_length=32, default='0,15,30,45', verbose_name=_(u"minute"), help_text=_(u'At which minute(s) the schedule should run.  For multiple entries with a comma.'))
-    hours = models.CharField(max_length=32, default='*', verbose_name=_(u"hours"), help_text=_(u'At which hour(s) the schedule should run.  For multiple entries with a comma.'))
-    day_of_month = models.CharField(max_length=32, default='*', verbose_name=_(u"day of the month"), help_text=_(u'At which day(s) of the month the schedule should run.  For multiple entries with a comma.'))
-    month = models.CharField(max_length=32, default='*', verbose_name=_(u"month"), help_text=_(u'At which month(s) the schedule should run.  For multiple entries with a comma.'))
-    day_of_week = models.CharField(max_length=32, default='*', verbose_name=_(u"day of the week"), help_text=_(u'At which day(s) of the week the schedule should run.  For multiple entries with a comma.'))
+    minute = models.CharField(max_length=32, default='0,15,30,45', verbose_name=_(u"minute"), help_text=_(u'At which minute(s) the schedule should run.  For multiple entries with a comma; ranges (10-20) and steps (*/10, 10-50/20) are also allowed.'))
+    hours = models.CharField(max_length=32, default='*', verbose_name=_(u"hours"), help_text=_(u'At which hour(s) the schedule should run.  For multiple entries with a comma; ranges (8-17) and steps (*/2) are also allowed.'))
+    day_of_month = models.CharField(max_length=32, default='*', verbose_name=_(u"day of the month"), help_text=_(u'At which day(s) of the month the schedule should run.  For multiple entries with a comma; ranges (1-15) and steps (*/7) are also allowed.'))
+    month = models.CharField(max_length=32, default='*', verbose_name=_(u"month"), help_text=_(u'At which month(s) the schedule should run.  For multiple entries with a comma; ranges (1-6) and steps (*/3) are also allowed.'))
+    day_of_week = models.CharField(max_length=32, default='*', verbose_name=_(u"day of the week"), help_text=_(u'At which day(s) of the week the schedule should run (0 = Monday).  For multiple entries with a comma; ranges (0-4) are also allowed.'))
     last_run = models.DateTimeField(blank=True, null=True, editable=False, verbose_name=_(u"last ran"))
     executing = models.BooleanField(editable=False, verbose_name=_(u"executing?"))
+    modified = models.DateTimeField(auto_now=True, editable=False, verbose_name=_(u"modified"))
 
     def __unicode__(self):
         output = "%s @ %s %s %s %s %s [%s]" % (self.conduit_set, self.minute, self.hours, self.day_of_month, self.month, self.day_of_week, self.enabled and 'X' or ' ')
@@ -205,10 +291,42 @@ class Schedule(models.Model):
             u'12': _(u"December"),
             u'*': _(u"All"),
         }
-        return ', '.join([unicode(months[m]) for m in self.month.split(',')])
+        return ', '.join([unicode(months.get(m, m)) for m in self.month.split(',')])
     month_name.short_description = _(u'month')
         
     class Meta:
         ordering = ('conduit_set',)
         verbose_name = _(u"schedule")
         verbose_name_plural = _(u"schedules")
+
+
+class Worker(models.Model):
+    hostname = models.CharField(max_length=64, verbose_name=_(u"hostname"))
+    pid = models.PositiveIntegerField(verbose_name=_(u"process id"))
+    started = models.DateTimeField(verbose_name=_(u"started"))
+    heartbeat = models.DateTimeField(help_text=_(u'Last time the worker reported being alive; it does so every REPLICATE_WORKER_HEARTBEAT seconds.'), verbose_name=_(u"heartbeat"))
+    running = models.PositiveIntegerField(default=0, help_text=_(u'Conduits being executed at the last heartbeat.'), verbose_name=_(u"running conduits"))
+    stopped = models.DateTimeField(blank=True, null=True, verbose_name=_(u"stopped"))
+
+    def __unicode__(self):
+        return "%s:%s" % (self.hostname, self.pid)
+
+    class Meta:
+        ordering = ('-started',)
+        verbose_name = _(u"worker")
+        verbose_name_plural = _(u"workers")
+
+
+class Lease(models.Model):
+    name = models.CharField(max_length=64, unique=True, help_text=_(u'What is being claimed, ie: "conduit:5" or "schedule:2".'), verbose_name=_(u"name"))
+    owner = models.CharField(max_length=128, help_text=_(u'Host and process id of the holder.'), verbose_name=_(u"owner"))
+    acquired = models.DateTimeField(verbose_name=_(u"acquired"))
+    expires = models.DateTimeField(help_text=_(u'The lease can be taken over by anyone after this time, the holder may have crashed.'), verbose_name=_(u"expires"))
+
+    def __unicode__(self):
+        return "%s @ %s" % (self.name, self.owner)
+
+    class Meta:
+        ordering = ('name',)
+        verbose_name = _(u"lease")
+        verbose_name_plural = _(u"leases")
@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from timeouts import TimeLimitExpired, Guard
+
+DEFAULT_REPLICATE_POOL_MAX_IDLE = 300
+DEFAULT_REPLICATE_POOL_MAX_PER_HOST = 8
+DEFAULT_REPLICATE_POOL_VALIDATION_INTERVAL = 30
+
+
+def connection_key(db):
+    """Connections can only be shared between databases with identical settings"""
+    return (db.backend, db.host.ip_address, db.port, db.name, db.username, db.password, db.timezone)
+
+
+def validation_query(db):
+    if db.backend == 'oracle':
+        return 'SELECT 1 FROM DUAL'
+    return 'SELECT 1'
+
+
+class ConnectionPool(object):
+    """Keeps the master/slave database connections of this process open between
+    conduit executions; idle connections are validated before being reused and
+    closed after [max_idle] seconds, and each host has a limit of open connections"""
+    def __init__(self, max_idle, max_per_host, validation_interval):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.validation_interval = validation_interval
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        #connection_key -> [(connection, released timestamp), ...]
+        self.idle = {}
+        #host ip address -> amount of open connections (idle or in use)
+        self.open_count = {}
+
+    def check_pid(self):
+        #Connections inherited from a parent process must not be used (or
+        #closed) by the child, they share the same socket
+        if self.pid != os.getpid():
+            self.reset()
+
+    def close_expired(self):
+        now = time.time()
+        for key, entries in self.idle.items():
+            for entry in entries[:]:
+                if now - entry[1] > self.max_idle:
+                    entries.remove(entry)
+                    self.close(key[1], entry[0])
+
+    def evict_idle(self, host):
+        """Close the least recently released idle connection to host, whatever
+        its database, to make room for another one; returns whether there was one"""
+        oldest = None
+        for key, entries in self.idle.items():
+            if key[1] == host and entries and (oldest is None or entries[0][1] < oldest[1][1]):
+                oldest = key, entries[0]
+        if oldest is None:
+            return False
+        key, entry = oldest
+        self.idle[key].remove(entry)
+        self.close(host, entry[0])
+        return True
+
+    def close(self, host, connection):
+        self.open_count[host] -= 1
+        try:
+            connection.close()
+        except:
+            pass
+        self.condition.notifyAll()
+
+    def validate(self, db, connection, factory, timeout):
+        try:
+            cursor = Guard(db, connection, factory).cursor(timeout)
+            cursor.execute(validation_query(db))
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except:
+            return False
+
+    def acquire(self, db, factory, timeout):
+        """Return an open connection to db, reusing an idle one if possible.
+        A host out of slots gives up its oldest idle connection (kept for
+        another database); otherwise waits up to timeout seconds for a free slot"""
+        key = connection_key(db)
+        host = key[1]
+        deadline = time.time() + timeout
+        while True:
+            self.condition.acquire()
+            try:
+                self.check_pid()
+                self.close_expired()
+                entries = self.idle.get(key)
+                if entries:
+                    connection, released = entries.pop()
+                elif self.open_count.get(host, 0) < self.max_per_host or self.evict_idle(host):
+                    self.open_count[host] = self.open_count.get(host, 0) + 1
+                    connection = released = None
+                else:
+                    #Every connection to host is in use; those of other hosts
+                    #expire in the meantime
+                    self.close_expired()
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeLimitExpired('timeout %r waiting for a free connection to host %s' % (timeout, host))
+                    self.condition.wait(remaining)
+                    continue
+            finally:
+                self.condition.release()
+
+            if connection is None:
+                try:
+                    return factory()
+                except:
+                    self.condition.acquire()
+                    try:
+                        self.open_count[host] -= 1
+                        self.condition.notifyAll()
+                    finally:
+                        self.condition.release()
+                    raise
+
+            if time.time() - released < self.validation_interval or self.validate(db, connection, factory, timeout):
+                return connection
+
+            self.discard(db, connection)
+
+    def release(self, db, connection):
+        """Give back a healthy connection for other conduits to reuse"""
+        try:
+            #Never hand over a pending transaction
+            connection._rollback()
+        except:
+            self.discard(db, connection)
+            return
+
+        self.condition.acquire()
+        try:
+            self.check_pid()
+            key = connection_key(db)
+            if key[1] in self.open_count:
+                self.idle.setdefault(key, []).append((connection, time.time()))
+                self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def discard(self, db, connection):
+        """Close a connection whose state can't be trusted anymore"""
+        self.condition.acquire()
+        try:
+            self.check_pid()
+            host = connection_key(db)[1]
+            if host in self.open_count:
+                self.close(host, connection)
+        finally:
+            self.condition.release()
+
+    def close_all(self):
+        self.condition.acquire()
+        try:
+            self.check_pid()
+            for key, entries in self.idle.items():
+                for connection, released in entries:
+                    self.close(key[1], connection)
+            self.idle = {}
+        finally:
+            self.condition.release()
+
+
+connection_pool = ConnectionPool(
+    getattr(settings, "REPLICATE_POOL_MAX_IDLE", DEFAULT_REPLICATE_POOL_MAX_IDLE),
+    getattr(settings, "REPLICATE_POOL_MAX_PER_HOST", DEFAULT_REPLICATE_POOL_MAX_PER_HOST),
+    getattr(settings, "REPLICATE_POOL_VALIDATION_INTERVAL", DEFAULT_REPLICATE_POOL_VALIDATION_INTERVAL))
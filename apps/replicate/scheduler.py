@@ -0,0 +1,194 @@
+import sys
+import heapq
+import datetime
+import threading
+import traceback
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.db.models.signals import post_save, post_delete
+
+from models import Schedule
+from executor import execute_schedule
+from utils import logger_es
+from debug import debug
+
+DEFAULT_REPLICATE_CHECKSCHEDULES_FREQUENCY = 35
+
+
+def compile_field(value, minimum, maximum):
+    """Compile a schedule field into a bitmap of the values it matches.
+    Supports '*', single values, ranges and steps, separated with commas:
+    '*', '5', '1-5', '*/10', '10-50/20', '0,30'.  Invalid entries are ignored"""
+    bitmap = 0
+    for part in value.replace(' ', '').split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            try:
+                step = int(step)
+            except ValueError:
+                continue
+            if step < 1:
+                continue
+
+        try:
+            if part == '*':
+                first, last = minimum, maximum
+            elif '-' in part:
+                first, last = [int(i) for i in part.split('-', 1)]
+            else:
+                first = int(part)
+                #'5/10' means from 5 to the end every 10
+                last = step > 1 and maximum or first
+        except ValueError:
+            continue
+
+        for i in range(max(first, minimum), min(last, maximum) + 1, step):
+            bitmap |= 1 << i
+    return bitmap
+
+
+def matches(bitmap, value):
+    return bitmap >> value & 1
+
+
+class CompiledSchedule(object):
+    def __init__(self, schedule):
+        self.pk = schedule.pk
+        self.minute = compile_field(schedule.minute, 0, 59)
+        self.hours = compile_field(schedule.hours, 0, 23)
+        self.day_of_month = compile_field(schedule.day_of_month, 1, 31)
+        self.month = compile_field(schedule.month, 1, 12)
+        #Same as datetime.weekday(); 0 = Monday
+        self.day_of_week = compile_field(schedule.day_of_week, 0, 6)
+
+    def next_fire_time(self, after):
+        """First minute strictly after [after] matching all the fields, None if
+        there is none in the next years (ie: February 30)"""
+        t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=366 * 5)
+        while t < limit:
+            if not (matches(self.month, t.month) and matches(self.day_of_month, t.day) and matches(self.day_of_week, t.weekday())):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif not matches(self.hours, t.hour):
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif not matches(self.minute, t.minute):
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+
+
+class Scheduler(object):
+    """Keeps the enabled schedules in a queue ordered by their next fire time
+    and sleeps until the first one is due.  Schedules are recompiled when they
+    are saved or deleted; changes made by other processes are noticed by
+    checking the schedule table every [check_frequency] seconds"""
+    def __init__(self, check_frequency):
+        self.check_frequency = check_frequency
+        self.queue = []
+        #Schedule pk -> last fire time, prevents firing twice in the same minute after a reload
+        self.fired = {}
+        self.fingerprint = None
+        self.reload = True
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def invalidate(self):
+        self.reload = True
+        self.wakeup.set()
+
+    def schedules_fingerprint(self):
+        fingerprint = Schedule.objects.aggregate(count=Count('id'), modified=Max('modified'))
+        return fingerprint['count'], fingerprint['modified']
+
+    def load(self, now):
+        self.reload = False
+        self.fingerprint = self.schedules_fingerprint()
+        self.queue = []
+        for schedule in Schedule.objects.filter(enabled=True):
+            compiled = CompiledSchedule(schedule)
+            #The current minute is still due unless it already fired
+            fire_time = compiled.next_fire_time(max(now - datetime.timedelta(minutes=1), self.fired.get(schedule.pk, datetime.datetime.min)))
+            if fire_time:
+                self.queue.append((fire_time, schedule.pk, compiled))
+        heapq.heapify(self.queue)
+        debug("scheduler.load: %d schedules" % len(self.queue))
+
+    def fire(self, pk, fire_time):
+        try:
+            schedule = Schedule.objects.get(pk=pk)
+        except Schedule.DoesNotExist:
+            return
+        #A schedule still executing (here or on another node) holds its lease
+        if schedule.enabled:
+            execute_schedule(schedule, fire_time)
+
+    def run_pending(self, now):
+        while self.queue and self.queue[0][0] <= now:
+            fire_time, pk, compiled = heapq.heappop(self.queue)
+            #Don't catch up on minutes missed while the process was suspended
+            if now - fire_time < datetime.timedelta(minutes=1):
+                debug("scheduler.fire: %s @ %s" % (pk, fire_time))
+                try:
+                    self.fire(pk, fire_time)
+                except:
+                    #The schedule stays queued for its next fire time
+                    (exc_type, exc_info, tb) = sys.exc_info()
+                    logger_es.error(u"Schedule: %s; Error firing; %s" % (pk, traceback.format_exception(exc_type, exc_info, None)[0]))
+            self.fired[pk] = fire_time
+            next_fire_time = compiled.next_fire_time(fire_time)
+            if next_fire_time:
+                heapq.heappush(self.queue, (next_fire_time, pk, compiled))
+
+    def run(self):
+        last_check = datetime.datetime.min
+        while not self.stopped.isSet():
+            now = datetime.datetime.now()
+            try:
+                if now - last_check >= datetime.timedelta(seconds=self.check_frequency):
+                    last_check = now
+                    if self.schedules_fingerprint() != self.fingerprint:
+                        self.reload = True
+                if self.reload:
+                    self.load(now)
+
+                self.run_pending(now)
+            except:
+                #The scheduler thread must outlive any error
+                (exc_type, exc_info, tb) = sys.exc_info()
+                logger_es.error(u"Scheduler error; %s" % traceback.format_exception(exc_type, exc_info, None)[0])
+
+            timeout = self.check_frequency
+            if self.queue:
+                due = self.queue[0][0] - datetime.datetime.now()
+                timeout = max(min(timeout, due.days * 86400 + due.seconds + due.microseconds / 1000000.0), 0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop firing schedules, waiting up to timeout seconds for a schedule
+        being fired to be handed over to the executor"""
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+
+scheduler = Scheduler(getattr(settings, "REPLICATE_CHECKSCHEDULES_FREQUENCY", DEFAULT_REPLICATE_CHECKSCHEDULES_FREQUENCY))
+
+
+def schedule_changed(sender, **kwargs):
+    scheduler.invalidate()
+
+post_save.connect(schedule_changed, sender=Schedule)
+post_delete.connect(schedule_changed, sender=Schedule)
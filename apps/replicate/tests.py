@@ -0,0 +1,255 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from django.test import TestCase
+
+from pool import ConnectionPool
+from writers import SQLiteWriter
+from models import Host, Database, Conduit, ConduitRun, Checkpoint
+from utils import execute_conduit, fetch_key_indexes, choose_key_columns, parametrized_subset
+from management.commands.replicate_benchmark import TABLE, generate_fixtures, count_rows
+
+
+class FakeHost(object):
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+
+
+class FakeDatabase(object):
+    def __init__(self, name, host):
+        self.backend = 'sqlite3'
+        self.host = host
+        self.port = None
+        self.name = name
+        self.username = None
+        self.password = None
+        self.timezone = None
+
+
+class FakeConnection(object):
+    closed = False
+
+    def _rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(300, 4, 30)
+        self.host = FakeHost('127.0.0.1')
+
+    def test_idle_connections_of_other_databases_are_evicted(self):
+        """A host serving more databases than max_per_host reuses the slots of
+        the idle connections kept for the other databases"""
+        opened = []
+        for i in range(6):
+            db = FakeDatabase('db%d' % i, self.host)
+            connection = self.pool.acquire(db, FakeConnection, 0.1)
+            opened.append(connection)
+            self.pool.release(db, connection)
+
+        self.assertEqual(self.pool.open_count[self.host.ip_address], 4)
+        #The least recently released ones were closed
+        self.assertEqual([connection.closed for connection in opened], [True, True, False, False, False, False])
+
+    def test_busy_host_still_times_out(self):
+        from timeouts import TimeLimitExpired
+        for i in range(4):
+            self.pool.acquire(FakeDatabase('db%d' % i, self.host), FakeConnection, 0.1)
+        self.assertRaises(TimeLimitExpired, self.pool.acquire, FakeDatabase('db4', self.host), FakeConnection, 0.1)
+
+
+class MergeReplicationTest(TestCase):
+    """The benchmark fixtures replicated end to end with the merge strategy,
+    whose key streams must not block the SQLite slave writes"""
+    rows = 2000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rt')
+        self.host = Host.objects.create(name='test', ip_address='127.0.0.1')
+
+    def tearDown(self):
+        self.host.delete()
+        shutil.rmtree(self.directory, True)
+
+    def replicate(self, key, slave_writer, batchsize):
+        directory = tempfile.mkdtemp(dir=self.directory)
+        missing = generate_fixtures(directory, self.rows, key, 0.1, 0)
+        master_db = Database.objects.create(host=self.host, backend='sqlite3', name=os.path.join(directory, 'master.db'))
+        slave_db = Database.objects.create(host=self.host, backend='sqlite3', name=os.path.join(directory, 'slave.db'))
+        conduit = Conduit.objects.create(name='test', master_db=master_db, slave_db=slave_db,
+            master_table=TABLE, slave_table=TABLE, diff_strategy='merge', batchsize=batchsize,
+            slave_writer=slave_writer, checkpoint_max_age=0, dry_run=False, timeout=600, major_timeout=600)
+        self.assertEqual(execute_conduit(conduit), None)
+        run = ConduitRun.objects.filter(conduit=conduit).order_by('-started')[0]
+        self.assertEqual(run.status, 'S')
+        appended = min(missing, batchsize)
+        self.assertEqual(run.rows_appended, appended)
+        self.assertEqual(count_rows(slave_db.name), self.rows - missing + appended)
+
+    def test_insert_writer(self):
+        for key in ('int', 'composite', 'string'):
+            self.replicate(key, 'insert', self.rows)
+
+    def test_batch_smaller_than_missing_keys(self):
+        for slave_writer in (None, 'insert'):
+            self.replicate('int', slave_writer, 50)
+
+
+class RawConnection(object):
+    """The part of a Django connection wrapper used by the slave writers"""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _commit(self):
+        self.connection.commit()
+
+
+class SQLiteWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='wt')
+        self.connection = sqlite3.connect(os.path.join(self.directory, 'slave.db'))
+        self.connection.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+        self.connection.execute("CREATE TABLE child (id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED)")
+        self.connection.commit()
+        self.connection.execute("PRAGMA foreign_keys = ON")
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory, True)
+
+    def test_failed_commit(self):
+        """A COMMIT failing at the end of the load is rolled back, the real
+        error is raised and nothing is counted"""
+        counters = {'rows_inserted': 0, 'keys_processed': 0}
+        writer = SQLiteWriter(None, RawConnection(self.connection), self.connection.cursor(), 'child', "INSERT INTO child VALUES (?, ?)", counters)
+        writer.begin()
+        writer.load([(1, 10), (2, 20)])
+        writer.counted('rows_inserted', 2)
+        writer.processed(2)
+        self.assertRaises(sqlite3.IntegrityError, writer.finish)
+        self.assertEqual(counters, {'rows_inserted': 0, 'keys_processed': 0})
+        self.assertEqual(self.connection.execute("SELECT COUNT(*) FROM child").fetchone()[0], 0)
+        self.assertEqual(self.connection.execute("PRAGMA synchronous").fetchone()[0], writer.synchronous)
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def timed(self, timeout, name, *args):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+class KeyIndexesTest(unittest.TestCase):
+    def test_mysql_prefix_index(self):
+        """A unique index on a column prefix is no key, not even on its other columns"""
+        conduit = Conduit(minor_timeout=10)
+        #SHOW INDEX: Table | Non_unique | Key_name | Seq_in_index | Column_name | Collation | Cardinality | Sub_part
+        cursor = FakeCursor([
+            ('t', 0, 'name_code', 1, 'name', 'A', 10, 10),
+            ('t', 0, 'name_code', 2, 'code', 'A', 10, None),
+            ('t', 0, 'serial', 1, 'serial', 'A', 10, None),
+        ])
+        indexes = fetch_key_indexes(conduit, 'mysql', cursor, 't', u'test')
+        self.assertEqual(indexes, [('serial', False, 1, 'serial')])
+        self.assertEqual(choose_key_columns(conduit, indexes), ['serial'])
+
+
+class IncrementalSubsetTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='it')
+        self.host = Host.objects.create(name='test', ip_address='127.0.0.1')
+        self.databases = {}
+        for side in ('master', 'slave'):
+            filename = os.path.join(self.directory, '%s.db' % side)
+            connection = sqlite3.connect(filename)
+            connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name VARCHAR(10), stamp INTEGER)")
+            connection.commit()
+            connection.close()
+            self.databases[side] = Database.objects.create(host=self.host, backend='sqlite3', name=filename)
+
+    def tearDown(self):
+        self.host.delete()
+        shutil.rmtree(self.directory, True)
+
+    def add_master_rows(self, ids):
+        connection = sqlite3.connect(self.databases['master'].name)
+        connection.executemany("INSERT INTO t VALUES (?, ?, ?)", [(i, 'n%d' % i, i) for i in ids])
+        connection.commit()
+        connection.close()
+
+    def test_subset_with_percent_sign(self):
+        """A LIKE pattern in the subset keeps working once the high water mark is bound"""
+        conduit = Conduit.objects.create(name='test', master_db=self.databases['master'], slave_db=self.databases['slave'],
+            master_table='t', slave_table='t', master_subset="name LIKE 'n1%'", incremental_column='stamp',
+            checkpoint_max_age=0, dry_run=False, timeout=600, major_timeout=600)
+        self.add_master_rows(range(1, 21))
+        self.assertEqual(execute_conduit(conduit), None)
+        self.add_master_rows(range(100, 120))
+        conduit = Conduit.objects.get(pk=conduit.pk)
+        self.assertEqual(conduit.high_water_mark, u'19')
+        self.assertEqual(execute_conduit(conduit), None)
+        self.assertEqual(Conduit.objects.get(pk=conduit.pk).high_water_mark, u'119')
+        connection = sqlite3.connect(self.databases['slave'].name)
+        #n1, n10-n19 and n100-n119
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM t").fetchone()[0], 31)
+        connection.close()
+
+    def test_parametrized_subset(self):
+        mysql = Database(backend='mysql')
+        oracle = Database(backend='oracle')
+        #As interpolated by MySQLdb and psycopg2
+        self.assertEqual((parametrized_subset(mysql, "name LIKE 'a%'") + " AND id >= %s") % ("1",), "name LIKE 'a%' AND id >= 1")
+        self.assertEqual(parametrized_subset(oracle, "name LIKE 'a%%'"), "name LIKE 'a%%'")
+        self.assertEqual(parametrized_subset(mysql, None), None)
+
+
+class CheckpointTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ct')
+        self.host = Host.objects.create(name='test', ip_address='127.0.0.1')
+        generate_fixtures(self.directory, 1000, 'int', 0.1, 0)
+        self.master_db = Database.objects.create(host=self.host, backend='sqlite3', name=os.path.join(self.directory, 'master.db'))
+        self.slave_db = Database.objects.create(host=self.host, backend='sqlite3', name=os.path.join(self.directory, 'slave.db'))
+
+    def tearDown(self):
+        self.host.delete()
+        shutil.rmtree(self.directory, True)
+
+    def conduit(self, **kwargs):
+        return Conduit.objects.create(name='test', master_db=self.master_db, slave_db=self.slave_db,
+            master_table=TABLE, slave_table=TABLE, batchsize=10, dry_run=False, timeout=600, major_timeout=600, **kwargs)
+
+    def test_not_checkpointed_by_default(self):
+        conduit = self.conduit()
+        self.assertEqual(execute_conduit(conduit), None)
+        self.assertFalse(Checkpoint.objects.filter(conduit=conduit).exists())
+
+    def test_discarded_with_other_metadata(self):
+        conduit = self.conduit(checkpoint_max_age=3600)
+        self.assertEqual(execute_conduit(conduit), None)
+        created = Checkpoint.objects.get(conduit=conduit).created
+
+        #Resumed
+        self.assertEqual(execute_conduit(Conduit.objects.get(pk=conduit.pk)), None)
+        self.assertEqual(Checkpoint.objects.get(conduit=conduit).created, created)
+
+        #Compared again once the metadata of the changed tables is detected
+        for side in ('master', 'slave'):
+            connection = sqlite3.connect(os.path.join(self.directory, '%s.db' % side))
+            connection.execute("ALTER TABLE %s ADD COLUMN extra INTEGER" % TABLE)
+            connection.commit()
+            connection.close()
+        Conduit.objects.filter(pk=conduit.pk).update(metadata=None)
+        self.assertEqual(execute_conduit(Conduit.objects.get(pk=conduit.pk)), None)
+        self.assertTrue(Checkpoint.objects.get(conduit=conduit).created > created)
@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import threading
+
+from debug import debug
+
+
+class TimeLimitExpired(Exception):
+    """Raised when a statement or a whole conduit runs past its time limit"""
+    pass
+
+
+class Deadline(object):
+    """Time left to a conduit execution; no statement gets a timeout past it,
+    so the conduit is stopped at the first statement or fetch after it expires"""
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.time() + timeout
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise TimeLimitExpired('conduit timeout %r' % self.timeout)
+
+    def limit(self, timeout):
+        self.check()
+        return min(timeout, self.remaining())
+
+
+class Statement(object):
+    def __init__(self, guard, timeout):
+        self.guard = guard
+        self.timeout = timeout
+        self.expires = time.time() + timeout
+        self.expired = False
+
+
+class Watchdog(object):
+    """A single thread per process cancelling the statements that run past
+    their timeout; statements register when they start and unregister when
+    they return, no thread is created per call"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.statements = set()
+        self.wakeup = None
+        self.pid = None
+
+    def start(self):
+        #The thread doesn't survive forking into worker processes, start one per process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.statements = set()
+            self.wakeup = None
+            thread = threading.Thread(target=self.run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def watch(self, guard, timeout):
+        statement = Statement(guard, timeout)
+        self.condition.acquire()
+        try:
+            self.start()
+            self.statements.add(statement)
+            #Only wake the thread up if it would sleep past this statement
+            if self.wakeup is None or statement.expires < self.wakeup:
+                self.condition.notify()
+        finally:
+            self.condition.release()
+        return statement
+
+    def done(self, statement):
+        self.condition.acquire()
+        try:
+            self.statements.discard(statement)
+        finally:
+            self.condition.release()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while True:
+                now = time.time()
+                for statement in [statement for statement in self.statements if statement.expires <= now]:
+                    self.statements.discard(statement)
+                    statement.expired = True
+                    debug("watchdog.cancel: %s after %ss" % (statement.guard.backend, statement.timeout))
+                    statement.guard.cancel()
+
+                if self.statements:
+                    self.wakeup = min([statement.expires for statement in self.statements])
+                    self.condition.wait(max(self.wakeup - now, 0))
+                else:
+                    self.wakeup = None
+                    self.condition.wait()
+        finally:
+            self.condition.release()
+
+
+watchdog = Watchdog()
+
+
+class Guard(object):
+    """Enforces statement timeouts on a database connection.  configure()
+    sets the backend's own statement timeout, so the server gives up on a
+    statement nobody is waiting for anymore (MySQL max_execution_time, SELECTs
+    only; PostgreSQL statement_timeout); Oracle gets a call timeout and SQLite
+    a progress handler per statement.  On top of that the watchdog cancels the
+    running statement the way the driver allows (KILL QUERY through a second
+    connection for MySQL)"""
+    def __init__(self, db, connection, factory, deadline=None):
+        self.backend = db.backend
+        self.connection = connection
+        self.factory = factory
+        self.deadline = deadline
+        self.statement = None
+        #Set when the connection can't be handed over to anyone else
+        self.abandoned = False
+
+    def configure(self, timeout):
+        milliseconds = int(timeout * 1000)
+        try:
+            if self.backend == 'mysql':
+                cursor = self.connection.cursor()
+                cursor.execute("SET SESSION max_execution_time = %d" % milliseconds)
+                cursor.close()
+            elif self.backend in ('postgresql', 'postgresql_psycopg2'):
+                cursor = self.connection.cursor()
+                cursor.execute("SET statement_timeout = %d" % milliseconds)
+                cursor.close()
+                #Otherwise rolled back along with the transaction it started
+                self.connection._commit()
+            elif self.backend == 'sqlite3':
+                self.connection.connection.set_progress_handler(self.progress, 1000)
+        except:
+            #Older servers and drivers; the watchdog still cancels the statement
+            debug("guard.configure: %s; native statement timeout not supported" % self.backend)
+            if self.backend in ('postgresql', 'postgresql_psycopg2'):
+                self.connection._rollback()
+
+    def progress(self):
+        """SQLite progress handler, a true value interrupts the running statement"""
+        statement = self.statement
+        if statement and time.time() >= statement.expires:
+            statement.expired = True
+            return 1
+        return 0
+
+    def cancel(self):
+        """Called from the watchdog thread while the statement is running"""
+        raw = self.connection.connection
+        if raw is None:
+            return
+        try:
+            if self.backend == 'mysql':
+                killer = self.factory()
+                try:
+                    killer.cursor().execute("KILL QUERY %d" % raw.thread_id())
+                finally:
+                    killer.close()
+            elif hasattr(raw, 'interrupt'):
+                #SQLite
+                raw.interrupt()
+            elif hasattr(raw, 'cancel'):
+                #psycopg2, cx_Oracle
+                raw.cancel()
+            else:
+                raw.close()
+        except:
+            debug("guard.cancel: %s; %s" % (self.backend, sys.exc_info()[1]))
+
+    def call(self, timeout, function, *args):
+        """Call function, a statement on this connection, cancelling it after timeout seconds"""
+        if self.deadline:
+            timeout = self.deadline.limit(timeout)
+        raw = self.connection.connection
+        if raw is not None and hasattr(raw, 'callTimeout'):
+            #cx_Oracle >= 7.2
+            raw.callTimeout = int(timeout * 1000)
+        statement = self.statement = watchdog.watch(self, timeout)
+        try:
+            return function(*args)
+        except:
+            if statement.expired:
+                raise TimeLimitExpired('timeout %r' % timeout)
+            raise
+        finally:
+            watchdog.done(statement)
+            self.statement = None
+
+    def cursor(self, timeout):
+        """Open a cursor whose statements are limited to timeout seconds by default"""
+        return GuardedCursor(self.call(timeout, self.connection.cursor), self, timeout)
+
+
+class GuardedCursor(object):
+    def __init__(self, cursor, guard, timeout):
+        self.cursor = cursor
+        self.guard = guard
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def timed(self, timeout, name, *args):
+        """Call a cursor method with a timeout other than the cursor's default"""
+        return self.guard.call(timeout or self.timeout, getattr(self.cursor, name), *args)
+
+    def execute(self, *args):
+        return self.timed(None, 'execute', *args)
+
+    def executemany(self, *args):
+        return self.timed(None, 'executemany', *args)
+
+    def fetchone(self):
+        return self.timed(None, 'fetchone')
+
+    def fetchmany(self, *args):
+        return self.timed(None, 'fetchmany', *args)
+
+    def fetchall(self):
+        return self.timed(None, 'fetchall')
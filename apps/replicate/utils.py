@@ -5,28 +5,186 @@ import sys
 import traceback
 import datetime	
 import time
-from multiprocessing import Process
+import zlib
+import threading
+import Queue
+from decimal import Decimal
+from hashlib import md5
+from itertools import islice
+from multiprocessing.util import Finalize
 
 from django.conf import settings
-from django.db import connection as django_connection
+from django.db import connection as django_connection, transaction
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response, get_object_or_404
+from django.utils import simplejson
 from django.utils.importlib import import_module
 from django.utils.encoding import smart_unicode
 
-from timelimited import TimeLimited, TimeLimitExpired
-from models import Conduit, Log
+from timeouts import TimeLimitExpired, Deadline, Guard, GuardedCursor
+from models import Conduit, ConduitRun, Log
+from pool import connection_pool
+from keys import CompactKeys
+from checkpoints import load_checkpoint, save_checkpoint
+from writers import SlaveWriter, slave_writer, DEFAULT_REPLICATE_MYSQL_LOCAL_INFILE
 from debug import debug
 
+#Backends that understand row value constructors: (a, b) IN ((1, 2), (3, 4))
+ROW_VALUE_BACKENDS = ('mysql', 'postgresql', 'postgresql_psycopg2', 'oracle')
+
+#Expressions assigning the (numeric) first key column to a bucket of
+#consecutive values, they must all round towards negative infinity
+BUCKET_EXPRESSIONS = {
+    'mysql': "FLOOR(%(column)s / %(size)d)",
+    'postgresql': "FLOOR(%(column)s / %(size)d.0)",
+    'postgresql_psycopg2': "FLOOR(%(column)s / %(size)d.0)",
+    'oracle': "FLOOR(%(column)s / %(size)d)",
+    #The SQLite cursor wrapper applies % formatting even without parameters
+    'sqlite3': "((%(column)s - ((%(column)s %%%% %(size)d) + %(size)d) %%%% %(size)d) / %(size)d)",
+    'ado_mssql': "FLOOR(%(column)s / %(size)d.0)",
+}
+
+class ConduitAborted(Exception):
+    """Raised to stop a conduit once the reason has already been logged"""
+    pass
+
+
+class ConduitStats(object):
+    """Wall time spent in each phase and counters of a single conduit execution"""
+    def __init__(self):
+        self.started = time.time()
+        self.times = dict.fromkeys(ConduitRun.PHASES, 0.0)
+        self.counters = {'master_keys': 0, 'slave_keys': 0, 'rows_inserted': 0, 'rows_updated': 0, 'rows_deleted': 0, 'keys_processed': 0, 'bytes_transferred': 0, 'master_warnings': 0, 'slave_warnings': 0}
+        #append_list position of the first row the slave refused to insert
+        self.first_skipped = None
+
+    def timed(self, phase, function, *args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.times[phase] += time.time() - start
+
+    def counted(self, keys, counter):
+        for key in keys:
+            self.counters[counter] += 1
+            yield key
+
+    def merge(self, partials):
+        """Add the statistics of work done in parallel; each phase took as long
+        as its slowest part"""
+        for phase in ConduitRun.PHASES:
+            self.times[phase] += max([partial.times[phase] for partial in partials])
+        for counter in self.counters:
+            self.counters[counter] += sum([partial.counters[counter] for partial in partials])
+
+    def save(self, run, status):
+        """Store the statistics in a ConduitRun record"""
+        run.finished = datetime.datetime.now()
+        run.status = status
+        run.total_time = time.time() - self.started
+        for phase in ConduitRun.PHASES:
+            setattr(run, '%s_time' % phase, self.times[phase])
+        run.master_keys = self.counters['master_keys']
+        run.slave_keys = self.counters['slave_keys']
+        run.rows_appended = self.counters['rows_inserted']
+        run.rows_updated = self.counters['rows_updated']
+        run.rows_deleted = self.counters['rows_deleted']
+        run.bytes_transferred = self.counters['bytes_transferred']
+        if run.total_time:
+            run.rows_per_second = run.rows_appended / run.total_time
+        run.save()
+
+
+def row_size(row):
+    """Approximate amount of bytes a row takes on the wire"""
+    return sum([len(smart_unicode(value)) for value in row if value is not None])
+
+
+DEFAULT_REPLICATE_LOG_DB_LEVEL = 'DEBUG'
+DEFAULT_REPLICATE_LOG_FLUSH_SIZE = 100
+DEFAULT_REPLICATE_LOG_FLUSH_INTERVAL = 2
+DEFAULT_REPLICATE_LOG_BUFFER_SIZE = 10000
+
 class DBHandler(logging.Handler):
-    """Custom loggin handler that outputs to a hardcoded DB table"""
+    """Custom loggin handler that outputs to a hardcoded DB table.
+    Records are buffered in memory and inserted in batches by a background
+    thread, once [flush_size] records are waiting or every [flush_interval]
+    seconds; records arriving while [buffer_size] records are waiting are dropped"""
+    def __init__(self, flush_size, flush_interval, buffer_size):
+        logging.Handler.__init__(self)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.dropped = 0
+        self.pid = None
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+
+    def start(self):
+        #The writer thread doesn't survive forking into worker processes, start one per process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.buffer = []
+            self.dropped = 0
+            writer = threading.Thread(target=self.run)
+            writer.setDaemon(True)
+            writer.start()
+            #multiprocessing children exit without calling atexit handlers
+            Finalize(None, self.flush, exitpriority=10)
+
     def emit(self, record):
-        ct = time.localtime(record.created)
-        log_entry = Log(
-            module = record.name,
-            severity = record.levelname,
-            message = record.msg
-        ).save()
+        self.condition.acquire()
+        try:
+            self.start()
+            if len(self.buffer) >= self.buffer_size:
+                self.dropped += 1
+            else:
+                self.buffer.append((datetime.datetime.fromtimestamp(record.created), record.name, record.levelname, record.getMessage()))
+                if len(self.buffer) >= self.flush_size:
+                    self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if len(self.buffer) < self.flush_size:
+                    self.condition.wait(self.flush_interval)
+            finally:
+                self.condition.release()
+            self.flush()
+
+    def flush(self):
+        self.flush_lock.acquire()
+        try:
+            self.condition.acquire()
+            try:
+                records, self.buffer = self.buffer, []
+                dropped, self.dropped = self.dropped, 0
+            finally:
+                self.condition.release()
+
+            if dropped:
+                records.append((datetime.datetime.now(), 'DBHandler', 'WARNING', u'%d log records were dropped, the log buffer was full.' % dropped))
+            if records:
+                self.write(records)
+        finally:
+            self.flush_lock.release()
+
+    def write(self, records):
+        qn = django_connection.ops.quote_name
+        columns = [qn(Log._meta.get_field(name).column) for name in ('timestamp', 'module', 'severity', 'message')]
+        query = "INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s)" % (qn(Log._meta.db_table), ", ".join(columns))
+        try:
+            cursor = django_connection.cursor()
+            cursor.executemany(query, [(django_connection.ops.value_to_db_datetime(timestamp), module, severity, message) for timestamp, module, severity, message in records])
+            transaction.commit_unless_managed()
+        except:
+            debug("DBHandler: %d log records lost; %s" % (len(records), sys.exc_info()[1]))
+            transaction.rollback_unless_managed()
 
 
 format="%(asctime)s |%(lineno)d |%(name)s |%(levelname)s | %(message)s"
@@ -50,7 +208,11 @@ ch.setFormatter(formatter)
 #logger_ec.addHandler(ch)
 #logger_es.addHandler(ch)
 
-dbhandler = DBHandler()
+dbhandler = DBHandler(
+    getattr(settings, "REPLICATE_LOG_FLUSH_SIZE", DEFAULT_REPLICATE_LOG_FLUSH_SIZE),
+    getattr(settings, "REPLICATE_LOG_FLUSH_INTERVAL", DEFAULT_REPLICATE_LOG_FLUSH_INTERVAL),
+    getattr(settings, "REPLICATE_LOG_BUFFER_SIZE", DEFAULT_REPLICATE_LOG_BUFFER_SIZE))
+dbhandler.setLevel(logging.getLevelName(getattr(settings, "REPLICATE_LOG_DB_LEVEL", DEFAULT_REPLICATE_LOG_DB_LEVEL)))
 logger_ec.addHandler(dbhandler)
 logger_es.addHandler(dbhandler)
 
@@ -88,35 +250,21 @@ def load_backend(backend_name):
             else:
                 raise # If there's some other error, this must be an error in Django itself.
 
-def execute_conduit_manually(conduit):
-    """Helper view to manually execute a conduit"""
-    try:
-        logger_ec.info(u'Conduit: %s; Manually executing conduit...' % conduit)
-
-        c_p = Process(target=execute_timed_conduit, args=(conduit,))
-        c_p.start()	
-#		execute_timed_conduit(conduit_obj)
-        
-    #	logger_ec.info('Conduit: %s; Finished manual execution.' % conduit_obj)
-        
-    except KeyboardInterrupt:
-        debug("KeyboardInterrupt @ execute_conduit")
-        
 #http://code.activestate.com/recipes/137270/  by Christopher Prinos & others
-def ResultIter(cursor, arraysize=1000, timeout=0):
+def ResultIter(cursor, arraysize=1000, timeout=None):
     """An iterator that uses fetchmany to keep memory usage down
     modified to add a timeout option"""
     try:	
         if arraysize != 0:
-            t_fetchmany = TimeLimited(cursor.fetchmany, timeout)
             while True:
-                results = t_fetchmany(arraysize)
+                results = cursor.timed(timeout, 'fetchmany', arraysize)
                 if not results:
                     break
                 for result in results:
                     yield result
         else:
-            yield TimeLimited(cursor.fetchall, timeout)()            
+            for result in cursor.timed(timeout, 'fetchall'):
+                yield result
     except KeyboardInterrupt:
         debug("KeyboardInterrupt @ ResultIter")
         return	
@@ -124,9 +272,7 @@ def ResultIter(cursor, arraysize=1000, timeout=0):
 def run_timed_query(cursor, log_msg, query_string, timeout=10, *query_args):
     """Run a timed query, do error handling and logging"""
     try:
-        result = TimeLimited(cursor.execute, timeout)(query_string, *query_args)
-#		result = cursor.execute(query_string, *query_args)
-        return result
+        return cursor.timed(timeout, 'execute', query_string, *query_args)
     except TimeLimitExpired:
         logger_ec.error(u'%s; Timeout error.' % log_msg)
         raise
@@ -139,13 +285,12 @@ def run_timed_query(cursor, log_msg, query_string, timeout=10, *query_args):
         raise
         
 def execute_timed_conduit(conduit_obj):
+    """Execute a conduit; the conduit timeout is enforced by execute_conduit
+    itself, every statement it runs is limited to the time left"""
     django_connection.close() 
 
     try:
-        return TimeLimited(execute_conduit, conduit_obj.timeout)(conduit_obj)
-    except TimeLimitExpired:
-        logger_ec.error(u'Conduit: %s; Conduit timeout error.' % conduit_obj)
-        return sys.exc_info()
+        return execute_conduit(conduit_obj)
     except KeyboardInterrupt:
         #print "KeyboardInterrupt @ execute_timed_conduit"
         return	
@@ -155,12 +300,101 @@ def execute_timed_conduit(conduit_obj):
         return traceback.format_exception(exc_type, exc_info, None)
 
 
+def fetch_keys(conduit, cursor, query, side, stats, *query_args):
+    """Run a key query, accounting its time to the master_keys or slave_keys phase"""
+    stats.timed('%s_keys' % side, run_timed_query, cursor, u'Conduit: %s; fetch_keys' % (conduit), query, conduit.major_timeout, *query_args)
+
+
+def fetch_key_set(conduit, cursor, side, stats):
+    """Fetch the result of a key query into a set"""
+    return stats.timed('%s_keys' % side, set, stats.counted(fix_encoding(ResultIter(cursor, getattr(conduit, '%s_key_batchsize' % side), conduit.major_timeout)), '%s_keys' % side))
+
+
+def fetch_compact_keys(conduit, cursor, side, stats):
+    """Fetch the result of a key query into CompactKeys, the driver's column
+    types tell which keys may be stored as integers"""
+    backend = getattr(conduit, '%s_db' % side).backend
+    keys = CompactKeys(cursor.description, getattr(load_backend(backend).Database, 'NUMBER', None))
+    stats.timed('%s_keys' % side, keys.add, stats.counted(ResultIter(cursor, getattr(conduit, '%s_key_batchsize' % side), conduit.major_timeout), '%s_keys' % side))
+    return keys
+
+
 def fix_encoding(keys):
     for key in keys:
         yield tuple(map(smart_unicode, key))
+
+
+def normalize_key_value(value):
+    """Numbers are kept as numbers so they sort like the database does,
+    everything else is compared as unicode"""
+    if isinstance(value, (int, long, float, Decimal)):
+        return value
+    return smart_unicode(value)
+
+
+def sorted_keys(keys, description):
+    """Normalize a key stream fetched with ORDER BY, making sure it really
+    is in ascending order from Python's point of view"""
+    previous = None
+    for key in keys:
+        key = tuple(map(normalize_key_value, key))
+        if previous is not None and key < previous:
+            raise ValueError(u'%s keys are not returned in ascending order (database collation differs from binary ordering); use the set comparison strategy for this conduit.' % description)
+        previous = key
+        yield key
+
+
+def distinct_keys(keys):
+    """Skip the repeated keys of an ascending key stream"""
+    previous = None
+    for key in keys:
+        if key != previous:
+            previous = key
+            yield key
+
+
+def merge_missing_keys(master_keys, slave_keys, deleted=None):
+    """Walk two ascending key streams in lockstep (merge-join) and yield the
+    master keys not found in the slave stream, without holding either one in memory.
+    Slave keys not found in the master stream are appended to deleted, if given"""
+    slave_keys = distinct_keys(slave_keys)
+    slave_key = next(slave_keys, None)
+    for master_key in distinct_keys(master_keys):
+        while slave_key is not None and slave_key < master_key:
+            if deleted is not None:
+                deleted.append(tuple(map(smart_unicode, slave_key)))
+            slave_key = next(slave_keys, None)
+        if slave_key == master_key:
+            slave_key = next(slave_keys, None)
+        else:
+            yield tuple(map(smart_unicode, master_key))
+
+    if deleted is not None:
+        while slave_key is not None:
+            deleted.append(tuple(map(smart_unicode, slave_key)))
+            slave_key = next(slave_keys, None)
+
         
-        
-def open_database(conduit, db):
+def subset_query(select, table, *predicates):
+    """Assemble a query over table restricted by all the given predicates, empty ones are skipped"""
+    query = "%s FROM %s" % (select, table)
+    predicates = [predicate for predicate in predicates if predicate]
+    if predicates:
+        query += " WHERE %s" % " AND ".join(["(%s)" % predicate for predicate in predicates])
+    return query
+
+
+def parametrized_subset(db, subset):
+    """A user subset predicate for a query run with parameters.  MySQLdb and
+    psycopg2 only interpolate queries given parameters, a literal % (ie: in a
+    LIKE pattern) must be escaped then; Oracle always interpolates them, the
+    subset is already escaped for it"""
+    if subset and db.backend != 'oracle':
+        return subset.replace('%', '%%')
+    return subset
+
+
+def create_connection(db):
     backend = load_backend(db.backend)
         
     if db.backend == 'oracle':
@@ -176,24 +410,138 @@ def open_database(conduit, db):
                 'TIME_ZONE': str(db.timezone),
             })
     else:
+        options = {}
+        if db.backend == 'sqlite3':
+            #Pooled connections are used by pipeline and partition threads
+            options['check_same_thread'] = False
+        if db.backend == 'mysql' and getattr(settings, "REPLICATE_MYSQL_LOCAL_INFILE", DEFAULT_REPLICATE_MYSQL_LOCAL_INFILE):
+            #For the LOAD DATA slave writer
+            options['local_infile'] = 1
         connection = backend.DatabaseWrapper({
             'HOST': db.host.ip_address,
             'NAME': db.name,
             #TODO: turn conduit.master_db.options into a dict
-            'OPTIONS': {},
+            'OPTIONS': options,
             'USER': db.username,
             'PASSWORD': db.password,
             'PORT': db.port,
             'TIME_ZONE': db.timezone,
         })
-    return connection, TimeLimited(connection.cursor, conduit.minor_timeout)()
+    return connection
+
+
+def open_database(conduit, db, deadline):
+    """Get a pooled connection to db and a cursor; statements are limited to
+    the conduit's major timeout and the time left to the conduit"""
+    factory = lambda: create_connection(db)
+    connection = connection_pool.acquire(db, factory, deadline.limit(conduit.minor_timeout))
+    try:
+        guard = Guard(db, connection, factory, deadline)
+        cursor = guard.cursor(conduit.minor_timeout)
+        guard.configure(conduit.major_timeout)
+        if db.backend == 'sqlite3':
+            connection.connection.create_function('replicate_hash', -1, replicate_hash)
+        cursor.timeout = conduit.major_timeout
+        return connection, cursor
+    except:
+        connection_pool.discard(db, connection)
+        raise
+
+
+def split_table_name(table):
+    """Split an optionally schema qualified table name into (schema, table)"""
+    if '.' in table:
+        return tuple(table.rsplit('.', 1))
+    return None, table
+
+
+def key_indexes_query(backend, table):
+    """Catalog query listing the primary key and unique indexes of a table as
+    (index name, is primary, position, column name) rows, None if unsupported"""
+    schema, name = split_table_name(table)
+    if backend == 'mysql':
+        return "SHOW INDEX FROM %s WHERE Non_unique = 0" % table
+    elif backend in ('postgresql', 'postgresql_psycopg2'):
+        #Partial and expression indexes can't identify rows
+        return """SELECT c.relname, i.indisprimary, s.n, a.attname
+            FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                CROSS JOIN generate_subscripts(i.indkey, 1) AS s(n)
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[s.n]
+            WHERE i.indrelid = '%s'::regclass AND i.indisunique AND i.indpred IS NULL AND i.indexprs IS NULL""" % table
+    elif backend == 'oracle':
+        owner = schema and "UPPER('%s')" % schema or "USER"
+        return """SELECT c.constraint_name, DECODE(c.constraint_type, 'P', 1, 0), l.position, l.column_name
+            FROM all_constraints c
+                JOIN all_cons_columns l ON l.owner = c.owner AND l.table_name = c.table_name AND l.constraint_name = c.constraint_name
+            WHERE c.constraint_type IN ('P', 'U') AND c.table_name = UPPER('%(name)s') AND c.owner = %(owner)s
+            UNION ALL
+            SELECT i.index_name, 0, l.column_position, l.column_name
+            FROM all_indexes i
+                JOIN all_ind_columns l ON l.index_owner = i.owner AND l.index_name = i.index_name
+            WHERE i.uniqueness = 'UNIQUE' AND i.table_name = UPPER('%(name)s') AND i.table_owner = %(owner)s
+                AND NOT EXISTS (SELECT 1 FROM all_constraints b WHERE b.owner = i.table_owner AND b.table_name = i.table_name AND b.index_name = i.index_name AND b.constraint_type IN ('P', 'U'))""" % {'name': name, 'owner': owner}
+    elif backend == 'ado_mssql':
+        query = """SELECT t.CONSTRAINT_NAME, CASE t.CONSTRAINT_TYPE WHEN 'PRIMARY KEY' THEN 1 ELSE 0 END, k.ORDINAL_POSITION, k.COLUMN_NAME
+            FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS t
+                JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k ON k.CONSTRAINT_SCHEMA = t.CONSTRAINT_SCHEMA AND k.CONSTRAINT_NAME = t.CONSTRAINT_NAME
+            WHERE t.CONSTRAINT_TYPE IN ('PRIMARY KEY', 'UNIQUE') AND t.TABLE_NAME = '%s'""" % name
+        if schema:
+            query += " AND t.TABLE_SCHEMA = '%s'" % schema
+        return query
+
+
+def fetch_key_indexes(conduit, backend, cursor, table, error_msg):
+    """(index name, is primary, position, column name) rows of the primary key
+    and unique indexes of a table"""
+    if backend == 'sqlite3':
+        #SQLITE table_info format = cid | name | type | notnull | dflt_value | pk (position in the key)
+        run_timed_query(cursor, error_msg, "PRAGMA table_info ('%s')" % table, conduit.minor_timeout)
+        indexes = [('PRIMARY', True, k[5], k[1]) for k in cursor.fetchall() if k[5]]
+        #index_list format = seq | name | unique
+        run_timed_query(cursor, error_msg, "PRAGMA index_list ('%s')" % table, conduit.minor_timeout)
+        for index in [k[1] for k in cursor.fetchall() if k[2]]:
+            #index_info format = seqno | cid | name
+            run_timed_query(cursor, error_msg, "PRAGMA index_info ('%s')" % index, conduit.minor_timeout)
+            indexes.extend([(index, False, k[0], k[2]) for k in cursor.fetchall()])
+        return indexes
+
+    query = key_indexes_query(backend, table)
+    if not query:
+        return
+    run_timed_query(cursor, error_msg, query, conduit.minor_timeout)
+    if backend == 'mysql':
+        #SHOW INDEX format = Table | Non_unique | Key_name | Seq_in_index | Column_name | Collation | Cardinality | Sub_part | ...
+        rows = cursor.fetchall()
+        #A prefix of a column doesn't make the index unique on the whole columns
+        prefixed = set([k[2] for k in rows if k[7] is not None])
+        return [(k[2], k[2] == 'PRIMARY', k[3], k[4]) for k in rows if k[2] not in prefixed]
+    return cursor.fetchall()
+
+
+def choose_key_columns(conduit, indexes):
+    """The columns of the primary key, or of the unique index with the fewest
+    columns if there is none, in index order"""
+    columns = {}
+    primary = []
+    for name, is_primary, position, column in indexes:
+        #An index may be listed more than once (ie: backing a constraint)
+        if (int(position), column) not in columns.setdefault(name, []):
+            columns[name].append((int(position), column))
+        if is_primary and name not in primary:
+            primary.append(name)
+    if not columns:
+        return []
+
+    if primary:
+        name = primary[0]
+    else:
+        name = min([(len(index_columns), index_name) for index_name, index_columns in columns.items()])[1]
+        logger_ec.warning(u'Conduit: %s; No primary key, using unique index %s as key; rows with NULL values in it will not be replicated correctly.' % (conduit, name))
+    return [column for position, column in sorted(columns[name])]
 
 
 def determine_primary_keys(conduit, master_cursor, slave_cursor):
-    # TODO: Implement also for other DBAs
-    #ORACLE - SELECT B.COLUMN_NAME FROM ALL_CONSTRAINS A, ALL_CONS_COLUMNS B WHERE A.CONSTRAINT_NAME=B.CONTRAINT_NAME AND A.TABLE=<> AND A.CONTRAINT_TYPE='P';
-    #ORACLE - SELECT * FROM ALL_CONSTRAINTS WHERE CONSTRAINT_TYPE='P' AND TABLE_NAME=<>
-    #SQLITE - PRAGMA INDEX_LIST('<>');
     logger_ec.debug(u"Conduit: %s; conduit.detect_primary_key: %s" % (conduit, conduit.detect_primary_key))
     logger_ec.debug(u"Conduit: %s; conduit.primary_key_source: %s" % (conduit, conduit.get_primary_key_source_display()))
     
@@ -209,56 +557,14 @@ def determine_primary_keys(conduit, master_cursor, slave_cursor):
         auto_table = conduit.slave_table
 
     if conduit.detect_primary_key:
-        if auto_backend == 'mysql':
-            query =  "SHOW INDEX FROM %s WHERE Key_name = 'PRIMARY'" % auto_table
-            error_msg = u'Conduit: %s; auto_db: %s; detecting_primary_key (mysql)' % (conduit, auto_db)
-            try:
-                run_timed_query(auto_cursor, error_msg, query, conduit.minor_timeout)
-            except:
-                raise
-        
-            pk_column_names = [(k[4]) for k in auto_cursor.fetchall()]
-        elif auto_backend == 'sqlite3':
-            query =  "PRAGMA table_info ('%s')" % auto_table
-            error_msg = u'Conduit: %s; auto_db: %s; detecting_primary_key (sqlite3)' % (conduit, auto_db)
-            #Untested
-            try:
-                run_timed_query(auto_cursor, error_msg, query, conduit.minor_timeout)
-            except:
-                raise
-            
-            #SQLITE format = cid | name | type | notnull | dflt_value | pk
-            pk_column_names = [k[1] for k in auto_cursor.fetchall() if k[5]]
-            """
-            elif auto_backend == 'oracle':
-    #			query = "SELECT B.COLUMN_NAME FROM ALL_CONSTRAINS A, ALL_CONS_COLUMNS B WHERE A.CONSTRAINT_NAME=B.CONTRAINT_NAME AND A.TABLE='%s' AND A.CONTRAINT_TYPE='P';" % auto_table
-    #			query = "SELECT * FROM ALL_CONSTRAINTS WHERE CONSTRAINT_TYPE='P' AND VIEW_NAME LIKE 's%%'"# % auto_table
-
-    #			query = u"
-    #				SELECT l.column_name, l.position
-    #				FROM all_constraints n
-    #					JOIN all_cons_columns l ON l.owner = n.owner AND l.table_name = n.table_name AND l.constraint_name = n.constraint_name
-    #					WHERE n.constraint_type = 'P' AND n.table_name = 'snap$_b1permit' AND n.owner LIKE '%%';
-    #			"
-
-    #			query = u"
-    #				SELECT all_cons_columns.column_name, all_cons_columns.position
-    #				FROM all_constraints n
-    #					JOIN all_cons_columns l
-    #						ON all_cons_columns.owner = all_constraints.owner
-    #						AND all_cons_columns.table_name = all_constraints.table_name
-    #						AND all_cons_columns.constraint_name = all_constraints.constraint_name
-    #					WHERE
-    #						all_constraints.constraint_type = 'P'
-    #						AND all_constraints.table_name = 'snap$_b1permit'
-    #						AND all_constraints.owner = 'SD'
-    #			"
-                pk_column_names = [k for k in auto_cursor.fetchall()]				
-            """
-        else:
+        error_msg = u'Conduit: %s; auto_db: %s; detecting_primary_key (%s)' % (conduit, auto_db, auto_backend)
+        indexes = fetch_key_indexes(conduit, auto_backend, auto_cursor, auto_table, error_msg)
+        if indexes is None:
             error_msg = u'Automatic primary key discovery is not yet supported this database backend.'
             logger_ec.error(u'Conduit: %s; auto_db: %s; %s' % (conduit, auto_db, error_msg))
             return
+
+        pk_column_names = choose_key_columns(conduit, indexes)
     else:
         pk_column_names = conduit.key_fields.split(',')
 
@@ -266,38 +572,437 @@ def determine_primary_keys(conduit, master_cursor, slave_cursor):
     if not pk_column_names or pk_column_names == ['']:
         error_msg = u'No primary key fields; check that your schema defines them, that automatic discover is supported for your database or provide them explicitly in the conduit.'
         logger_ec.error(u'Conduit: %s; auto_db: %s; %s' % (conduit, auto_db, error_msg))
-        raise
+        raise ValueError(error_msg)
     
     return auto_backend, auto_table, auto_cursor, pk_column_names
 
 
-def determine_append_list(conduit, master_cursor, slave_cursor, master_query, slave_query):
-    #EXECUTE KEY FETCH IN SLAVE
+#Bump when the cached metadata changes meaning, invalidating all of it
+METADATA_VERSION = 2
+
+def metadata_fingerprint(conduit):
+    """Hash of the conduit settings the cached metadata was detected with"""
+    settings_used = (METADATA_VERSION, conduit.master_db_id, conduit.master_db.backend, conduit.slave_db_id, conduit.slave_db.backend,
+        conduit.master_table, conduit.master_subset, conduit.slave_table, conduit.slave_subset,
+        conduit.primary_key_source, conduit.detect_primary_key, conduit.key_fields, conduit.fields_to_fetch)
+    #Not repr(), a conduit just saved holds str values where a loaded one has unicode
+    return md5(u'\x00'.join([smart_unicode(value) for value in settings_used]).encode('utf-8')).hexdigest()
+
+
+def cached_metadata(conduit):
+    """The primary key columns and assembled queries of a previous execution,
+    None if there are none or the conduit settings changed since"""
+    if not conduit.metadata:
+        return
+    try:
+        metadata = simplejson.loads(conduit.metadata)
+    except ValueError:
+        return
+    if metadata.get('fingerprint') != metadata_fingerprint(conduit):
+        logger_ec.debug(u'Conduit: %s; Conduit settings changed, detecting metadata again.' % conduit)
+        return
+    return metadata
+
+
+def store_metadata(conduit, metadata):
+    if metadata:
+        metadata['fingerprint'] = metadata_fingerprint(conduit)
+        metadata['detected'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metadata = simplejson.dumps(metadata)
+    else:
+        metadata = None
+    conduit.metadata = metadata
+    Conduit.objects.filter(pk=conduit.pk).update(metadata=metadata)
+
+
+def determine_metadata(conduit, master_cursor, slave_cursor, stats):
+    """Primary key columns and assembled queries, detected on the databases
+    unless cached by a previous execution"""
+    metadata = cached_metadata(conduit)
+    if metadata:
+        logger_ec.debug(u'Conduit: %s; Using metadata cached on %s.' % (conduit, metadata['detected']))
+        return metadata, True
+
+    auto_backend, auto_table, auto_cursor, pk_column_names = stats.timed('primary_key', determine_primary_keys, conduit, master_cursor, slave_cursor)
+    master_query, slave_query, insert_template, fields_to_fetch, keys_template = stats.timed('assemble', assemble_queries, conduit, auto_backend, auto_table, auto_cursor, pk_column_names)
+    metadata = {
+        'pk_column_names': pk_column_names,
+        'master_query': master_query,
+        'slave_query': slave_query,
+        'insert_template': insert_template,
+        'fields_to_fetch': fields_to_fetch,
+        'keys_template': keys_template,
+    }
+    store_metadata(conduit, metadata)
+    return metadata, False
+
+
+def determine_incremental_append_list(conduit, master_cursor, slave_cursor, pk_column_names, stats):
+    """Compare only the keys of the rows at or beyond the conduit's high water
+    mark; returns the missing keys in incremental column order, the mark value
+    of each one of them and the highest mark seen on master"""
+    column = conduit.incremental_column
+    logger_ec.debug(u'Conduit: %s; incremental_column: %s' % (conduit, column))
+    logger_ec.debug(u'Conduit: %s; high_water_mark: %s' % (conduit, conduit.high_water_mark))
+
+    if conduit.high_water_mark:
+        #Rows at the mark itself are compared again, rows sharing its value may
+        #not have been appended when the previous run stopped at its batchsize
+        mark_predicate = "%s >= %%s" % column
+        mark_args = ([conduit.high_water_mark],)
+        master_subset = parametrized_subset(conduit.master_db, conduit.master_subset)
+        slave_subset = parametrized_subset(conduit.slave_db, conduit.slave_subset)
+    else:
+        mark_predicate = None
+        #Not even an empty parameter list, MySQLdb would interpolate the query
+        mark_args = ()
+        master_subset = conduit.master_subset
+        slave_subset = conduit.slave_subset
+
+    keys_query = "SELECT " + ", ".join(pk_column_names)
+    master_query = subset_query("%s, %s" % (keys_query, column), conduit.master_table, master_subset, "%s IS NOT NULL" % column, mark_predicate) + " ORDER BY %s" % column
+    slave_query = subset_query(keys_query, conduit.slave_table, slave_subset, mark_predicate)
+
+    logger_ec.debug(u'Conduit: %s; master_db: %s; incremental master_query: %s' % (conduit, conduit.master_db, master_query))
+    logger_ec.debug(u'Conduit: %s; slave_db: %s; incremental slave_query: %s' % (conduit, conduit.slave_db, slave_query))
+
+    fetch_keys(conduit, slave_cursor, slave_query, 'slave', stats, *mark_args)
+    fetch_keys(conduit, master_cursor, master_query, 'master', stats, *mark_args)
+
+    key_length = len(pk_column_names)
+    append_list = []
+    marks = []
+    last_mark = None
+    try:
+        slave_keys = fetch_key_set(conduit, slave_cursor, 'slave', stats)
+        #Master keys are compared while being fetched
+        diff_start = time.time()
+        for row in stats.counted(ResultIter(master_cursor, conduit.master_key_batchsize, conduit.major_timeout), 'master_keys'):
+            key = tuple(map(smart_unicode, row[:key_length]))
+            last_mark = row[key_length]
+            if key not in slave_keys:
+                slave_keys.add(key)
+                append_list.append(key)
+                marks.append(last_mark)
+    except TimeLimitExpired:
+        logger_ec.error(u'Conduit: %s; Fetching keys; Timeout error' % conduit)
+        raise
+    stats.times['diff'] += time.time() - diff_start
+
+    logger_ec.info(u'Conduit: %s; Total rows to append: %s' % (conduit, len(append_list)))
+
+    return append_list, marks, last_mark
+
+
+def update_high_water_mark(conduit, append_list, marks, last_mark, first_skipped=None):
+    """Persist how far the incremental replication got, only rows beyond the
+    conduit batchsize are left for the next execution.  The mark stops at the
+    first row the slave refused (first_skipped) so the next execution retries it"""
+    if conduit.dry_run:
+        return
+
+    if first_skipped is not None and first_skipped < min(len(append_list), conduit.batchsize):
+        mark = marks[first_skipped]
+    elif len(append_list) > conduit.batchsize:
+        mark = marks[conduit.batchsize]
+    elif last_mark is not None:
+        mark = last_mark
+    else:
+        return
+
+    conduit.high_water_mark = smart_unicode(mark)
+    #Only touch this field, the conduit may have been edited while executing
+    Conduit.objects.filter(pk=conduit.pk).update(high_water_mark=conduit.high_water_mark)
+    logger_ec.debug(u'Conduit: %s; new high_water_mark: %s' % (conduit, conduit.high_water_mark))
+
+
+def key_hash_expression(backend, pk_column_names):
+    """Aggregate hashing all the key columns of a bucket, None if the backend has no hash function"""
+    if backend == 'mysql':
+        return "SUM(CRC32(CONCAT_WS('|', %s)))" % ", ".join(pk_column_names)
+    elif backend in ('postgresql', 'postgresql_psycopg2'):
+        return "SUM(hashtext(%s)::bigint)" % " || '|' || ".join(["%s::text" % k for k in pk_column_names])
+    elif backend == 'oracle':
+        return "SUM(ORA_HASH(%s))" % " || '|' || ".join(pk_column_names)
+    elif backend == 'ado_mssql':
+        return "SUM(CAST(CHECKSUM(%s) AS BIGINT))" % ", ".join(pk_column_names)
+    elif backend == 'sqlite3':
+        #Registered by open_database
+        return "SUM(replicate_hash(%s))" % ", ".join(pk_column_names)
+
+
+def replicate_hash(*values):
+    """SQLite function hashing a key, for key_hash_expression"""
+    return zlib.crc32(u'|'.join([smart_unicode(value) for value in values]).encode('utf-8')) & 0xffffffff
+
+
+def checksum_hash_expression(conduit, pk_column_names):
+    """The bucket hash aggregate, None if the databases can't hash keys the
+    same way (different backends); an aggregate of the key values alone can't
+    tell {1, 4} from {2, 3}"""
+    if conduit.master_db.backend == conduit.slave_db.backend:
+        return key_hash_expression(conduit.master_db.backend, pk_column_names)
+
+
+def bucket_checksums(conduit, cursor, side, backend, table, subset, pk_column_names, hash_expression, stats):
+    """Fetch {bucket: (count, hash)} for the key buckets of a table, computed by the database"""
+    bucket = BUCKET_EXPRESSIONS[backend] % {'column': pk_column_names[0], 'size': max(conduit.checksum_bucket_size, 1)}
+    query = subset_query("SELECT %s, COUNT(*), %s" % (bucket, hash_expression), table, subset) + " GROUP BY %s" % bucket
+    stats.timed('%s_keys' % side, run_timed_query, cursor, u'Conduit: %s; fetch_bucket_checksums' % (conduit), query, conduit.major_timeout)
+    return stats.timed('%s_keys' % side, dict, ((int(row[0]), tuple(row[1:])) for row in ResultIter(cursor, 0, conduit.major_timeout)))
+
+
+def bucket_ranges(buckets):
+    """Group sorted bucket numbers into (first, last) runs of consecutive buckets"""
+    ranges = []
+    for bucket in buckets:
+        if ranges and ranges[-1][1] == bucket - 1:
+            ranges[-1][1] = bucket
+        else:
+            ranges.append([bucket, bucket])
+    return ranges
+
+
+def determine_checksum_append_list(conduit, master_cursor, slave_cursor, pk_column_names, stats, delete_list=None):
+    """Compare per bucket key counts and hashes computed inside both databases
+    and only fetch and compare the keys of the buckets that differ"""
+    master_backend = conduit.master_db.backend
+    slave_backend = conduit.slave_db.backend
+    for backend in (master_backend, slave_backend):
+        if backend not in BUCKET_EXPRESSIONS:
+            error_msg = u'Checksum key comparison is not yet supported for this database backend: %s.' % backend
+            logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+            raise ValueError(error_msg)
+
+    hash_expression = checksum_hash_expression(conduit, pk_column_names)
+
+    logger_ec.debug(u'Conduit: %s; checksum_bucket_size: %s' % (conduit, conduit.checksum_bucket_size))
+    logger_ec.debug(u'Conduit: %s; checksum hash_expression: %s' % (conduit, hash_expression))
+
+    master_buckets = bucket_checksums(conduit, master_cursor, 'master', master_backend, conduit.master_table, conduit.master_subset, pk_column_names, hash_expression, stats)
+    slave_buckets = bucket_checksums(conduit, slave_cursor, 'slave', slave_backend, conduit.slave_table, conduit.slave_subset, pk_column_names, hash_expression, stats)
+
+    differing_buckets = [bucket for bucket, checksum in master_buckets.items() if slave_buckets.get(bucket) != checksum]
+    if delete_list is not None:
+        #Buckets only found on the slave hold nothing but keys to delete
+        differing_buckets.extend([bucket for bucket in slave_buckets if bucket not in master_buckets])
+    differing_buckets.sort()
+    logger_ec.debug(u'Conduit: %s; differing buckets: %d of %d' % (conduit, len(differing_buckets), len(master_buckets)))
+
+    keys_query = "SELECT " + ", ".join(pk_column_names)
+    column = pk_column_names[0]
+    size = max(conduit.checksum_bucket_size, 1)
+    append_list = []
     try:
-        run_timed_query(slave_cursor, u'Conduit: %s; fetch_keys' % (conduit), slave_query, conduit.major_timeout)
+        for first, last in bucket_ranges(differing_buckets):
+            range_predicate = "%s >= %d AND %s < %d" % (column, first * size, column, (last + 1) * size)
+            fetch_keys(conduit, slave_cursor, subset_query(keys_query, conduit.slave_table, conduit.slave_subset, range_predicate), 'slave', stats)
+            fetch_keys(conduit, master_cursor, subset_query(keys_query, conduit.master_table, conduit.master_subset, range_predicate), 'master', stats)
+            master_keys = fetch_compact_keys(conduit, master_cursor, 'master', stats)
+            slave_keys = fetch_compact_keys(conduit, slave_cursor, 'slave', stats)
+            append_list.extend(stats.timed('diff', master_keys.difference, slave_keys))
+            if delete_list is not None:
+                delete_list.extend(stats.timed('diff', slave_keys.difference, master_keys))
+    except TimeLimitExpired:
+        logger_ec.error(u'Conduit: %s; Fetching keys; Timeout error' % conduit)
+        raise
+
+    logger_ec.info(u'Conduit: %s; Total rows to append: %s' % (conduit, len(append_list)))
+
+    return append_list
+
+
+def key_column_range(conduit, master_cursor, slave_cursor, column):
+    """The lowest and highest values of a key column on both databases, None
+    if they aren't numeric"""
+    values = []
+    for cursor, table, subset in ((master_cursor, conduit.master_table, conduit.master_subset), (slave_cursor, conduit.slave_table, conduit.slave_subset)):
+        run_timed_query(cursor, u'Conduit: %s; key_range' % conduit, subset_query("SELECT MIN(%s), MAX(%s)" % (column, column), table, subset), conduit.major_timeout)
+        values.extend([value for value in cursor.fetchone() if value is not None])
+
+    for value in values:
+        if not isinstance(value, (int, long, float, Decimal)):
+            return
+    return values
+
+
+def partition_predicates(conduit, master_cursor, slave_cursor, pk_column_names):
+    """Split the range of the first key column, between its lowest and highest
+    value on either database, into [diff_partitions] predicates covering every
+    possible value; None if the column isn't numeric or the range too small"""
+    column = pk_column_names[0]
+    values = key_column_range(conduit, master_cursor, slave_cursor, column)
+    if values is None:
+        logger_ec.warning(u'Conduit: %s; Key comparison partitions need a numeric first key column, comparing all the keys at once.' % conduit)
+        return
+    if not values:
+        return
+
+    low = long(min(values))
+    high = long(max(values)) + 1
+    boundaries = sorted(set([low + (high - low) * i / conduit.diff_partitions for i in range(1, conduit.diff_partitions)]) - set([low]))
+    if not boundaries:
+        return
+
+    predicates = []
+    for i in range(len(boundaries) + 1):
+        bounds = []
+        if i > 0:
+            bounds.append("%s >= %d" % (column, boundaries[i - 1]))
+        if i < len(boundaries):
+            bounds.append("%s < %d" % (column, boundaries[i]))
+        predicates.append(" AND ".join(bounds))
+    return predicates
+
+
+def partition_key_diff(conduit, deadline, predicate, pk_column_names, stats):
+    """Compare the keys matching predicate over a dedicated pair of connections,
+    returns (master only keys, slave only keys)"""
+    keys_query = "SELECT " + ", ".join(pk_column_names)
+    master_connection, master_cursor = stats.timed('connect', open_database, conduit, conduit.master_db, deadline)
+    try:
+        slave_connection, slave_cursor = stats.timed('connect', open_database, conduit, conduit.slave_db, deadline)
     except:
+        connection_pool.release(conduit.master_db, master_connection)
         raise
 
     try:
-        run_timed_query(master_cursor, u'Conduit: %s; fetch_keys' % (conduit), master_query, conduit.major_timeout)
+        fetch_keys(conduit, slave_cursor, subset_query(keys_query, conduit.slave_table, conduit.slave_subset, predicate), 'slave', stats)
+        fetch_keys(conduit, master_cursor, subset_query(keys_query, conduit.master_table, conduit.master_subset, predicate), 'master', stats)
+        master_keys = fetch_compact_keys(conduit, master_cursor, 'master', stats)
+        slave_keys = fetch_compact_keys(conduit, slave_cursor, 'slave', stats)
+        result = stats.timed('diff', master_keys.difference, slave_keys), stats.timed('diff', slave_keys.difference, master_keys)
     except:
+        connection_pool.discard(conduit.master_db, master_connection)
+        connection_pool.discard(conduit.slave_db, slave_connection)
         raise
+
+    connection_pool.release(conduit.master_db, master_connection)
+    connection_pool.release(conduit.slave_db, slave_connection)
+    return result
+
+
+def determine_partitioned_append_list(conduit, deadline, predicates, pk_column_names, stats, delete_list=None):
+    """Compare the keys of each partition in its own thread and merge the results"""
+    logger_ec.debug(u'Conduit: %s; diff_partitions: %s' % (conduit, predicates))
+    results = [None] * len(predicates)
+    partials = [ConduitStats() for predicate in predicates]
+
+    def compare(i):
+        try:
+            results[i] = ('done', partition_key_diff(conduit, deadline, predicates[i], pk_column_names, partials[i]))
+        except:
+            results[i] = ('error', sys.exc_info())
+
+    threads = [threading.Thread(target=compare, args=(i,)) for i in range(len(predicates))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.merge(partials)
+
+    append_list = []
+    for kind, value in results:
+        if kind == 'error':
+            raise value[0], value[1], value[2]
+        append_list.extend(value[0])
+        if delete_list is not None:
+            delete_list.extend(value[1])
+
+    logger_ec.debug(u'Conduit: %s; master_keys: %s' % (conduit, stats.counters['master_keys']))
+    logger_ec.debug(u'Conduit: %s; slave_keys: %s' % (conduit, stats.counters['slave_keys']))
+    logger_ec.info(u'Conduit: %s; Total rows to append: %s' % (conduit, len(append_list)))
+
+    return append_list
+
+
+def merge_append_list(conduit, deadline, master_query, slave_query, stats, delete_list=None):
+    """Generator of the merge strategy, the ordered keys of both databases are
+    streamed from server side cursors over a dedicated pair of connections,
+    released once the comparison is over.  The keys of SQLite slaves are read
+    whole first, an open read would hold a lock blocking the slave writes"""
+    master_connection, master_cursor = stats.timed('connect', open_database, conduit, conduit.master_db, deadline)
+    try:
+        slave_connection, slave_cursor = stats.timed('connect', open_database, conduit, conduit.slave_db, deadline)
+    except:
+        connection_pool.release(conduit.master_db, master_connection)
+        raise
+    connections = [(conduit.master_db, master_connection), (conduit.slave_db, slave_connection)]
+
+    logger_ec.debug(u'Conduit: %s; Starting streaming and merging keys from master and slave....' % conduit)
+    try:
+        if conduit.slave_db.backend == 'sqlite3':
+            fetch_keys(conduit, slave_cursor, slave_query, 'slave', stats)
+            slave_keys = stats.timed('slave_keys', list, sorted_keys(stats.counted(ResultIter(slave_cursor, conduit.slave_key_batchsize, conduit.major_timeout), 'slave_keys'), u'Slave'))
+            connection_pool.release(*connections.pop())
+        else:
+            slave_stream = streaming_cursor(conduit, conduit.slave_db, slave_connection, slave_cursor, 'slave_keys')
+            fetch_keys(conduit, slave_stream, streaming_select(conduit.slave_db, slave_cursor.guard, slave_query), 'slave', stats)
+            slave_keys = sorted_keys(stats.counted(ResultIter(slave_stream, conduit.slave_key_batchsize, conduit.major_timeout), 'slave_keys'), u'Slave')
+        master_keys = streaming_cursor(conduit, conduit.master_db, master_connection, master_cursor, 'master_keys')
+        fetch_keys(conduit, master_keys, streaming_select(conduit.master_db, master_cursor.guard, master_query), 'master', stats)
+        for key in merge_missing_keys(
+                sorted_keys(stats.counted(ResultIter(master_keys, conduit.master_key_batchsize, conduit.major_timeout), 'master_keys'), u'Master'),
+                slave_keys, delete_list):
+            yield key
+    except:
+        #Also when the comparison is abandoned half way, the streams are still open
+        for db, connection in connections:
+            connection_pool.discard(db, connection)
+        raise
+
+    for db, connection in connections:
+        connection_pool.release(db, connection)
+
+
+def determine_append_list(conduit, master_cursor, slave_cursor, master_query, slave_query, pk_column_names, stats, delete_list=None):
+    """Keys found on master but not on slave; keys found only on the slave
+    are added to delete_list, if given"""
+    if conduit.diff_strategy == 'checksum':
+        if not checksum_hash_expression(conduit, pk_column_names):
+            logger_ec.warning(u'Conduit: %s; Bucket checksums need both databases to be of the same kind, comparing the keys with an in memory set difference.' % conduit)
+        elif stats.timed('diff', key_column_range, conduit, master_cursor, slave_cursor, pk_column_names[0]) is None:
+            #SQLite would silently put every string in bucket 0
+            logger_ec.warning(u'Conduit: %s; Bucket checksums need a numeric first key column, comparing the keys with an in memory set difference.' % conduit)
+        else:
+            return determine_checksum_append_list(conduit, master_cursor, slave_cursor, pk_column_names, stats, delete_list)
+
+    if conduit.diff_partitions > 1 and conduit.diff_strategy == 'set':
+        predicates = stats.timed('diff', partition_predicates, conduit, master_cursor, slave_cursor, pk_column_names)
+        if predicates:
+            return determine_partitioned_append_list(conduit, master_cursor.guard.deadline, predicates, pk_column_names, stats, delete_list)
+
+    if conduit.diff_strategy == 'merge':
+        order_by = " ORDER BY %s" % ", ".join(pk_column_names)
+        #Keys are compared while they are being fetched, only the missing ones
+        #are kept; the time spent is accounted to the diff phase by insert_rows
+        return merge_append_list(conduit, master_cursor.guard.deadline, master_query + order_by, slave_query + order_by, stats, delete_list)
+
+    #EXECUTE KEY FETCH IN SLAVE
+    fetch_keys(conduit, slave_cursor, slave_query, 'slave', stats)
+    fetch_keys(conduit, master_cursor, master_query, 'master', stats)
    
     #EXECUTE KEY FETCH in MASTER
     logger_ec.debug(u'Conduit: %s; Starting fetching and comparing keys from master and slave....' % conduit)
 
     logger_ec.debug(u'Conduit: %s; master_key_buffersize: %s' % (conduit, conduit.master_key_batchsize))
     logger_ec.debug(u'Conduit: %s; slave_key_buffersize: %s' % (conduit, conduit.slave_key_batchsize))
+    logger_ec.debug(u'Conduit: %s; diff_strategy: %s' % (conduit, conduit.get_diff_strategy_display()))
 
     try:
-        append_list = list(set(fix_encoding(ResultIter(master_cursor, conduit.master_key_batchsize, conduit.major_timeout))) - set(fix_encoding(ResultIter(slave_cursor, conduit.slave_key_batchsize, conduit.major_timeout))))
+        master_keys = fetch_compact_keys(conduit, master_cursor, 'master', stats)
+        slave_keys = fetch_compact_keys(conduit, slave_cursor, 'slave', stats)
+        append_list = stats.timed('diff', master_keys.difference, slave_keys)
+        if delete_list is not None:
+            delete_list.extend(stats.timed('diff', slave_keys.difference, master_keys))
 
     except TimeLimitExpired:
         logger_ec.error(u'Conduit: %s; Fetching keys; Timeout error' % conduit)
         raise
 
-    logger_ec.debug(u'Conduit: %s; master_keys: %s' % (conduit, master_cursor.rowcount))
-    logger_ec.debug(u'Conduit: %s; slave_keys: %s' % (conduit, slave_cursor.rowcount))
+    logger_ec.debug(u'Conduit: %s; master_keys: %s' % (conduit, stats.counters['master_keys']))
+    logger_ec.debug(u'Conduit: %s; slave_keys: %s' % (conduit, stats.counters['slave_keys']))
     logger_ec.info(u'Conduit: %s; Total rows to append: %s' % (conduit, len(append_list)))
 
     return append_list
@@ -306,17 +1011,12 @@ def determine_append_list(conduit, master_cursor, slave_cursor, master_query, sl
 def assemble_queries(conduit, auto_backend, auto_table, auto_cursor, pk_column_names):
    #Assemble query to fetch keys
     keys_query = "SELECT "+ ", ".join(["%s" % k for k in pk_column_names])
-    keys_template = " AND ".join(["%s='%%s'" % k for k in pk_column_names])
+    keys_template = " AND ".join(["%s = %%s" % k for k in pk_column_names])
 
     logger_ec.debug(u"Conduit: %s; keys_template: %s" % (conduit, keys_template))
 
-    master_query = "%s FROM %s" % (keys_query, conduit.master_table)
-    if conduit.master_subset:
-        master_query += " WHERE %s" % conduit.master_subset
-
-    slave_query = "%s FROM %s" % (keys_query, conduit.slave_table)
-    if conduit.slave_subset:
-        slave_query += " WHERE %s" % conduit.slave_subset
+    master_query = subset_query(keys_query, conduit.master_table, conduit.master_subset)
+    slave_query = subset_query(keys_query, conduit.slave_table, conduit.slave_subset)
 
     logger_ec.debug(u'Conduit: %s; master_db: %s; master_query: %s' % (conduit, conduit.master_db, master_query))
     logger_ec.debug(u'Conduit: %s; slave_db: %s; slave_query: %s' % (conduit, conduit.slave_db, slave_query))
@@ -329,19 +1029,17 @@ def assemble_queries(conduit, auto_backend, auto_table, auto_cursor, pk_column_n
     
     logger_ec.debug(u'Conduit: %s; fields_to_fetch: %s' % (conduit, fields_to_fetch))
 
-    #TODO:
-    #	- sqlite3
-
-    if auto_backend == 'mysql' or auto_backend == 'postgresql' or auto_backend == 'postgresql_psycopg2':
+    if auto_backend in ('mysql', 'postgresql', 'postgresql_psycopg2', 'sqlite3'):
         query = 'SELECT %s FROM %s LIMIT 1' % (fields_to_fetch, auto_table)
     elif auto_backend == 'oracle':
         query = 'SELECT %s FROM %s WHERE ROWNUM <= 1' % (fields_to_fetch, auto_table)
     elif auto_backend == 'ado_mssql':
         #UNTESTED
-        query = 'SELECT TOP 1 % FROM %s' % (fields_to_fetch, auto_table)
+        query = 'SELECT TOP 1 %s FROM %s' % (fields_to_fetch, auto_table)
     else:
-        logger_ec.error(u'Conduit: %s; Automatic database field description is not yet supported this database backend: %s.' % (conduit, auto_backend))
-        return True
+        error_msg = u'Automatic database field description is not yet supported this database backend: %s.' % auto_backend
+        logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+        raise ValueError(error_msg)
 
     run_timed_query(auto_cursor, u'Conduit: %s; fields_to_fetch' % (conduit),  query, conduit.minor_timeout)
 
@@ -357,71 +1055,587 @@ def assemble_queries(conduit, auto_backend, auto_table, auto_cursor, pk_column_n
     return master_query, slave_query, insert_template, fields_to_fetch, keys_template
 
 
-def insert_rows(conduit, append_list, fields_to_fetch, keys_template, insert_template, master_cursor, slave_cursor):
+def chunks(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, max(size, 1)))
+        if not chunk:
+            return
+        yield chunk
+
+
+def assemble_keys_predicate(backend, pk_column_names, keys_template, keys, size=0):
+    """Build a WHERE predicate that matches a whole chunk of keys at once and
+    its parameters.  Chunks smaller than size are padded by repeating their
+    last key, so every chunk shares the same statement text and the server
+    only parses it once"""
+    keys = list(keys)
+    keys.extend(keys[-1:] * (size - len(keys)))
+    params = [value for key in keys for value in key]
+    if len(pk_column_names) == 1:
+        return "%s IN (%s)" % (pk_column_names[0], ", ".join(["%s"] * len(keys))), params
+    elif backend in ROW_VALUE_BACKENDS:
+        #(a, b) IN ((%s, %s), (%s, %s))
+        return "(%s) IN (%s)" % (", ".join(pk_column_names), ", ".join(["(%s)" % ", ".join(["%s"] * len(pk_column_names))] * len(keys))), params
+    else:
+        return " OR ".join(["(%s)" % keys_template] * len(keys)), params
+
+
+def fetch_master_rows(conduit, master_cursor, keys, fields_to_fetch, keys_template, pk_column_names):
+    """Fetch the master rows for a chunk of keys with a single query, returns
+    a list of (key, rows) in the same order the keys were requested"""
+    #Key columns are fetched too, to match the returned rows to the requested keys
+    predicate, params = assemble_keys_predicate(conduit.master_db.backend, pk_column_names, keys_template, keys, conduit.fetch_chunk_size)
+    query = "SELECT %s, %s FROM %s WHERE %s" % (", ".join(pk_column_names), fields_to_fetch, conduit.master_table, predicate)
+    run_timed_query(master_cursor, u'Conduit: %s; master_db_fetch_row' % conduit, query, conduit.major_timeout, params)
+
+    key_length = len(pk_column_names)
+    fetched_rows = {}
+    for row in ResultIter(master_cursor, 0, conduit.major_timeout):
+        fetched_rows.setdefault(tuple(map(smart_unicode, row[:key_length])), []).append(row[key_length:])
+
+    return [(key, fetched_rows.get(tuple(key), [])) for key in keys]
+
+
+def modify_slave_rows(conduit, slave_connection, slave_cursor, template, rows, counters, counter='rows_inserted', operation='row_insert', writer=None, skipped=None):
+    """Apply a statement template to a chunk of rows on the slave with a single
+    executemany (or the bulk load of writer) inside a transaction; a failing
+    chunk is rolled back and retried row by row so errors are still handled
+    (and counted) per row, the positions of the ignored rows are added to the
+    skipped list.  Returns False if the conduit must abort"""
+    if conduit.dry_run:
+        return True
+
+    if writer is None:
+        writer = SlaveWriter(conduit, slave_connection, slave_cursor, None, template, counters)
+
+    if len(rows) > 1:
+        try:
+            writer.load(rows)
+            writer.commit()
+            writer.counted(counter, len(rows))
+            return True
+        except:
+            (exc_type, exc_info, tb) = sys.exc_info()
+            writer.rollback()
+            logger_ec.debug(u'Conduit: %s; bulk %s error (%s), retrying %d rows one by one; %s' % (conduit, operation, writer.name, len(rows), exc_info))
+
+    for position, row in enumerate(rows):
+        try:
+            writer.insert(row)
+            writer.commit()
+            writer.counted(counter, 1)
+        except:
+            (exc_type, exc_info, tb) = sys.exc_info()
+            writer.rollback()
+            if conduit.ignore_slave_modify_errors:
+                if skipped is not None:
+                    skipped.append(position)
+                counters['slave_warnings'] += 1
+                logger_ec.warning(u'Conduit: %s; %s error; %s' % (conduit, operation, exc_info))
+                if counters['slave_warnings'] > conduit.slave_warnings_abort_threshold and conduit.slave_warnings_abort_threshold != 0:
+                    error_msg = u'Slave warning count threshold has been exceded.'
+                    logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+                    return False
+            else:
+                logger_ec.error(u'Conduit: %s; %s error: %s' % (conduit, operation, exc_info))
+                return False
+
+    return True
+
+
+def fetch_append_rows(conduit, append_list, fields_to_fetch, keys_template, master_cursor, pk_column_names, stats):
+    """Generator that fetches the rows to append from master, yielding a list
+    of validated rows per fetch chunk, with None in place of the keys skipped
+    because their rows were not found"""
+    counters = stats.counters
+    key_chunks = chunks(islice(append_list, conduit.batchsize), conduit.fetch_chunk_size)
+    while True:
+        #Streamed key comparisons do their work while keys are being pulled
+        key_chunk = stats.timed('diff', next, key_chunks, None)
+        if key_chunk is None:
+            break
+
+        #Fetch a chunk of rows from master
+        try:
+            fetched_rows = stats.timed('row_fetch', fetch_master_rows, conduit, master_cursor, key_chunk, fields_to_fetch, keys_template, pk_column_names)
+        except:
+            (exc_type, exc_info, tb) = sys.exc_info()
+            logger_ec.error(u'Conduit: %s; master_db_fetch_row error; %s' % (conduit, exc_info))
+            raise ConduitAborted
+
+        rows_to_append = []
+        for key, rows in fetched_rows:
+            if len(rows) != 1:
+                error_msg = 'Single master query returned an unexpected number or rows (0 or more than 1), check your primary keys (key: %s).' % (key,)
+                if conduit.ignore_master_pull_errors:
+                    logger_ec.warning(u'Conduit: %s; %s' % (conduit, error_msg))
+                    counters['master_warnings'] += 1
+                    if counters['master_warnings'] > conduit.master_warnings_abort_threshold and conduit.master_warnings_abort_threshold != 0:
+                        error_msg = u'Master warning count threshold has been exceded.'
+                        logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+                        raise ConduitAborted
+                    if not rows:
+                        rows_to_append.append(None)
+                        continue
+                else:
+                    logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+                    raise ConduitAborted
+
+            rows_to_append.append(rows[0])
+            counters['bytes_transferred'] += row_size(rows[0])
+
+        yield rows_to_append
+
+
+def pipeline(conduit, row_chunks, guard):
+    """Consume the row_chunks generator from a reader thread, handing the chunks
+    over through a bounded queue so master fetches overlap with slave inserts.
+    guard is the one of the master connection the reader fetches from"""
+    queue = Queue.Queue(max(conduit.pipeline_queue_depth, 1))
+    stop = threading.Event()
+
+    def hand_over(item):
+        while not stop.isSet():
+            try:
+                queue.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for rows in row_chunks:
+                if not hand_over(('rows', rows)):
+                    return
+            hand_over(('done', None))
+        except:
+            hand_over(('error', sys.exc_info()))
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.setDaemon(True)
+    reader_thread.start()
+
+    try:
+        while True:
+            try:
+                kind, value = queue.get(True, conduit.major_timeout)
+            except Queue.Empty:
+                logger_ec.error(u'Conduit: %s; Pipelined master row fetch; Timeout error.' % conduit)
+                raise TimeLimitExpired('timeout %r waiting for master rows' % conduit.major_timeout)
+
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        stop.set()
+        #The reader must be done with the master connection before it is
+        #reused; a fetch still running is cancelled
+        reader_thread.join(1)
+        if reader_thread.isAlive():
+            guard.cancel()
+            reader_thread.join(conduit.minor_timeout)
+        if reader_thread.isAlive():
+            logger_ec.error(u'Conduit: %s; Pipelined master row fetch did not stop, the master connection will be closed.' % conduit)
+            guard.abandoned = True
+
+
+def start_slave_writer(conduit, slave_connection, slave_cursor, table, insert_template, stats):
+    writer = slave_writer(conduit, slave_connection, slave_cursor, table, insert_template, stats.counters)
+    logger_ec.debug(u'Conduit: %s; slave_writer: %s' % (conduit, writer.name))
+    if not conduit.dry_run:
+        stats.timed('insert', writer.begin)
+    return writer
+
+
+def finish_slave_writer(conduit, writer, stats):
+    if not conduit.dry_run and not writer.failed:
+        stats.timed('insert', writer.finish)
+
+
+def insert_rows(conduit, append_list, fields_to_fetch, keys_template, insert_template, master_cursor, slave_connection, slave_cursor, pk_column_names, stats):
     logger_ec.debug(u'Conduit: %s; batch_size: %s' % (conduit, conduit.batchsize))
+    logger_ec.debug(u'Conduit: %s; fetch_chunk_size: %s' % (conduit, conduit.fetch_chunk_size))
+    logger_ec.debug(u'Conduit: %s; insert_chunk_size: %s' % (conduit, conduit.insert_chunk_size))
+    logger_ec.debug(u'Conduit: %s; pipelined: %s' % (conduit, conduit.pipelined))
     logger_ec.debug(u'Conduit: %s; dry_run: %s' % (conduit, conduit.dry_run))
     logger_ec.debug(u'Conduit: %s; Starting row fetch...' % (conduit))
 
-    master_warning_counter = slave_warning_counter = row_fetch_count = 0
+    counters = stats.counters
+    writer = start_slave_writer(conduit, slave_connection, slave_cursor, conduit.slave_table, insert_template, stats)
+    insert_chunk_size = max(conduit.insert_chunk_size, 1)
+    #Rows (or None for skipped keys) in append_list order; keys_processed
+    #counts the leading append_list keys already dealt with
+    pending_rows = []
+    #append_list position of pending_rows[0]
+    offset = 0
+
+    def insert_chunk(chunk, offset):
+        positions = [offset + index for index, row in enumerate(chunk) if row is not None]
+        skipped = []
+        inserted = stats.timed('insert', modify_slave_rows, conduit, slave_connection, slave_cursor, insert_template, [row for row in chunk if row is not None], counters, writer=writer, skipped=skipped)
+        if skipped and stats.first_skipped is None:
+            stats.first_skipped = positions[skipped[0]]
+        return inserted
+
+    row_chunks = fetch_append_rows(conduit, append_list, fields_to_fetch, keys_template, master_cursor, pk_column_names, stats)
+    if conduit.pipelined:
+        row_chunks = pipeline(conduit, row_chunks, master_cursor.guard)
+
+    try:
+        for rows in row_chunks:
+            pending_rows.extend(rows)
+
+            #Insert rows into slave
+            while len(pending_rows) >= insert_chunk_size:
+                if not insert_chunk(pending_rows[:insert_chunk_size], offset):
+                    return
+                writer.processed(insert_chunk_size)
+                pending_rows = pending_rows[insert_chunk_size:]
+                offset += insert_chunk_size
+
+        if pending_rows:
+            if not insert_chunk(pending_rows, offset):
+                return
+            writer.processed(len(pending_rows))
+
+        if hasattr(append_list, 'close'):
+            #A streamed comparison finds the slave only keys by its end
+            diff_start = time.time()
+            for key in append_list:
+                pass
+            stats.times['diff'] += time.time() - diff_start
+    except ConduitAborted:
+        return
+    except:
+        #What the writer didn't commit goes away with the discarded connection
+        writer.failed = True
+        raise
+    finally:
+        row_chunks.close()
+        #The key streams (and their read locks) are gone before the writer commits
+        if hasattr(append_list, 'close'):
+            try:
+                append_list.close()
+            except ValueError:
+                #Still being read by an abandoned pipeline reader
+                pass
+        finish_slave_writer(conduit, writer, stats)
+
+    logger_ec.info(u'Conduit: %s; Total rows fetched from master db: %d.' % (conduit, counters['rows_inserted']))
+    return True
+
+
+def row_hash_expression(backend, fields):
+    """Expression hashing all the fetched fields of a row, None if the backend has no hash function"""
+    if backend == 'mysql':
+        return "MD5(CONCAT_WS('|', %s))" % ", ".join(["IFNULL(%s, '\\\\N')" % field for field in fields])
+    elif backend in ('postgresql', 'postgresql_psycopg2'):
+        return "MD5(ROW(%s)::text)" % ", ".join(fields)
+    elif backend == 'oracle':
+        return "ORA_HASH(%s)" % " || '|' || ".join(fields)
+    elif backend == 'ado_mssql':
+        return "BINARY_CHECKSUM(%s)" % ", ".join(fields)
+
+
+def row_digest(values):
+    """Client side row hash, for backends without a hash function"""
+    return md5(u'|'.join([value is None and u'\\N' or smart_unicode(value) for value in values]).encode('utf-8')).hexdigest()
+
+
+def fetch_row_hashes(conduit, cursor, side, table, subset, pk_column_names, fields, hash_expression, stats):
+    """Run the row hash query of one side, returns an iterator of key + (hash,)
+    tuples; without a hash expression the fields are fetched and hashed here"""
+    query = subset_query("SELECT %s, %s" % (", ".join(pk_column_names), hash_expression or ", ".join(fields)), table, subset)
+    if conduit.diff_strategy == 'merge':
+        query += " ORDER BY %s" % ", ".join(pk_column_names)
+    fetch_keys(conduit, cursor, query, side, stats)
+
+    key_length = len(pk_column_names)
+    def row_hashes():
+        for row in ResultIter(cursor, getattr(conduit, '%s_key_batchsize' % side), conduit.major_timeout):
+            if hash_expression:
+                yield tuple(row[:key_length]) + (smart_unicode(row[key_length]),)
+            else:
+                yield tuple(row[:key_length]) + (row_digest(row[key_length:]),)
+    return row_hashes()
+
+
+def merge_changed_keys(master_hashes, slave_hashes):
+    """Walk two ascending key + (hash,) streams in lockstep and yield the keys
+    found on both sides whose hashes differ"""
+    slave_hashes = iter(slave_hashes)
+    slave_row = next(slave_hashes, None)
+    for master_row in master_hashes:
+        key = master_row[:-1]
+        while slave_row is not None and slave_row[:-1] < key:
+            slave_row = next(slave_hashes, None)
+        if slave_row is not None and slave_row[:-1] == key and slave_row[-1] != master_row[-1]:
+            yield tuple(map(smart_unicode, key))
+
+
+def determine_update_list(conduit, master_cursor, slave_cursor, fields, pk_column_names, stats):
+    """Keys of the rows present on both master and slave whose hashes differ"""
+    master_backend = conduit.master_db.backend
+    slave_backend = conduit.slave_db.backend
+
+    #Both sides must hash the same way, otherwise hash here
+    hash_expression = master_backend == slave_backend and row_hash_expression(master_backend, fields)
+    logger_ec.debug(u'Conduit: %s; row hash_expression: %s' % (conduit, hash_expression or u'(client side)'))
+
+    slave_hashes = fetch_row_hashes(conduit, slave_cursor, 'slave', conduit.slave_table, conduit.slave_subset, pk_column_names, fields, hash_expression, stats)
+    master_hashes = fetch_row_hashes(conduit, master_cursor, 'master', conduit.master_table, conduit.master_subset, pk_column_names, fields, hash_expression, stats)
+
+    if conduit.diff_strategy == 'merge':
+        return merge_changed_keys(sorted_keys(master_hashes, u'Master'), sorted_keys(slave_hashes, u'Slave'))
+
+    slave_hashes = stats.timed('slave_keys', dict, ((row[:-1], row[-1]) for row in fix_encoding(slave_hashes)))
+    update_list = stats.timed('diff', list, (row[:-1] for row in fix_encoding(master_hashes) if slave_hashes.get(row[:-1], row[-1]) != row[-1]))
+    logger_ec.info(u'Conduit: %s; Total rows to update: %s' % (conduit, len(update_list)))
+    return update_list
+
+
+def update_rows(conduit, master_key_cursor, slave_key_cursor, fields_to_fetch, keys_template, master_cursor, slave_connection, slave_cursor, pk_column_names, stats):
+    """Update the slave rows that differ from master; returns True on completion"""
+    fields = [field.strip() for field in fields_to_fetch.split(',')]
+    update_list = determine_update_list(conduit, master_key_cursor, slave_key_cursor, fields, pk_column_names, stats)
+    update_template = "UPDATE %s SET %s WHERE %s" % (conduit.slave_table, ", ".join(["%s = %%s" % field for field in fields]), " AND ".join(["%s = %%s" % k for k in pk_column_names]))
+    logger_ec.debug(u'Conduit: %s; update_template: %s' % (conduit, update_template))
+
+    counters = stats.counters
+    key_chunks = chunks(islice(update_list, conduit.batchsize), conduit.fetch_chunk_size)
+    while True:
+        key_chunk = stats.timed('diff', next, key_chunks, None)
+        if key_chunk is None:
+            break
 
-    #TODO: convert this loop's db query,etc to timelimited
-    for key in append_list[:conduit.batchsize]:
-        #Fetch single row from master
         try:
-            master_cursor.execute("SELECT %s FROM %s WHERE %s " % (fields_to_fetch, conduit.master_table, (keys_template) % (tuple(key))))
-            #TODO: Implement multi-row fetch w/ cursor.executemany("SELECT ...", keys[])
+            fetched_rows = stats.timed('update', fetch_master_rows, conduit, master_cursor, key_chunk, ", ".join(fields), keys_template, pk_column_names)
         except:
             (exc_type, exc_info, tb) = sys.exc_info()
             logger_ec.error(u'Conduit: %s; master_db_fetch_row error; %s' % (conduit, exc_info))
             return
-        
-        #This is necesary to update rowcount
-        row = master_cursor.fetchall()[0]
-        #TODO: Implement multi-row fetch  w/ cursor.fetchmany(3) or w/ ResultIter
-        if master_cursor.rowcount != 1:
-            #TODO: rowcount != batch_block_size
-            error_msg = 'Single master query returned an unexpected number or rows (0 or more than 1), check your primary keys.'
-            if conduit.ignore_master_pull_errors:
-                logger_ec.warning(u'Conduit: %s; %s' % (conduit, error_msg))
-                master_warning_counter += 1
-                if master_warning_counter > conduit.master_warnings_abort_threshold and conduit.master_warnings_abort_threshold != 0:
-                    error_msg = u'Master warning count threshold has been exceded.'
-                    logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
-                    return
-            else:
-                logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+
+        #Rows deleted from master since their hash was fetched are skipped
+        rows = [tuple(rows[0]) + tuple(key) for key, rows in fetched_rows if len(rows) == 1]
+        for row_chunk in chunks(rows, conduit.update_chunk_size):
+            if not stats.timed('update', modify_slave_rows, conduit, slave_connection, slave_cursor, update_template, row_chunk, counters, 'rows_updated', 'row_update'):
                 return
 
-        #Insert row into slave
+    logger_ec.info(u'Conduit: %s; Total rows updated: %d.' % (conduit, counters['rows_updated']))
+    return True
+
+
+def count_slave_rows(conduit, slave_cursor):
+    run_timed_query(slave_cursor, u'Conduit: %s; count_slave_rows' % conduit, subset_query("SELECT COUNT(*)", conduit.slave_table, conduit.slave_subset), conduit.major_timeout)
+    return int(slave_cursor.fetchone()[0])
+
+
+def delete_rows(conduit, delete_list, slave_connection, slave_cursor, keys_template, pk_column_names, stats):
+    """Delete the slave rows of delete_list with chunked DELETE statements, one
+    transaction per chunk; returns True on completion"""
+    logger_ec.debug(u'Conduit: %s; Starting rows delete...' % (conduit))
+    logger_ec.info(u'Conduit: %s; Total rows to delete: %s' % (conduit, len(delete_list)))
+    if not delete_list:
+        return True
+
+    slave_rows = stats.timed('delete', count_slave_rows, conduit, slave_cursor)
+    percentage = len(delete_list) * 100.0 / max(slave_rows, 1)
+    if percentage > conduit.max_delete_percentage:
+        logger_ec.error(u'Conduit: %s; Refusing to delete %d of %d slave rows (%.1f%%), the maximum delete percentage is %d%%.' % (conduit, len(delete_list), slave_rows, percentage, conduit.max_delete_percentage))
+        return
+
+    if conduit.dry_run:
+        return True
+
+    counters = stats.counters
+    for keys in chunks(delete_list, conduit.delete_chunk_size):
+        predicate, params = assemble_keys_predicate(conduit.slave_db.backend, pk_column_names, keys_template, keys, conduit.delete_chunk_size)
+        query = "DELETE FROM %s WHERE %s" % (conduit.slave_table, predicate)
         try:
-            if not conduit.dry_run:
-                slave_cursor.execute(insert_template, row)
-                #cursor.executemany("INSERT INTO animals (name, species) VALUES (%s, %s)", [  ('Rollo', 'Rat'),  ('Dudley', 'Dolphin'),  ('Mark', 'Marmoset') ])
-                row_fetch_count += 1
-        except: 
+            stats.timed('delete', slave_cursor.execute, query, params)
+            stats.timed('delete', slave_connection._commit)
+            counters['rows_deleted'] += len(keys)
+        except:
             (exc_type, exc_info, tb) = sys.exc_info()
+            slave_connection._rollback()
+            if exc_type is TimeLimitExpired:
+                raise exc_type, exc_info, tb
             if conduit.ignore_slave_modify_errors:
-                slave_warning_counter += 1
-                logger_ec.warning(u'Conduit: %s; row_insert error; %s' % (conduit, exc_info))
-                if slave_warning_counter > conduit.slave_warnings_abort_threshold and conduit.slave_warnings_abort_threshold != 0:
-                    error_msg = u'Slave warning count threshold has been exceded.'
-                    logger_ec.error(u'Conduit: %s; %s' % (conduit, error_msg))
+                counters['slave_warnings'] += 1
+                logger_ec.warning(u'Conduit: %s; row_delete error; %s' % (conduit, exc_info))
+                if counters['slave_warnings'] > conduit.slave_warnings_abort_threshold and conduit.slave_warnings_abort_threshold != 0:
+                    logger_ec.error(u'Conduit: %s; Slave warning count threshold has been exceded.' % conduit)
                     return
             else:
-                logger_ec.error(u'Conduit: %s; row_insert error: %s' % (conduit, exc_info))
+                logger_ec.error(u'Conduit: %s; row_delete error: %s' % (conduit, exc_info))
                 return
 
-    logger_ec.info(u'Conduit: %s; Total rows fetched from master db: %d.' % (conduit, row_fetch_count))
+    logger_ec.info(u'Conduit: %s; Total rows deleted from slave db: %d.' % (conduit, counters['rows_deleted']))
+    return True
+
+
+def streaming_cursor(conduit, db, connection, cursor, name):
+    """A cursor over a connection to db that streams a big result instead
+    of buffering it whole in memory"""
+    backend = db.backend
+    raw = connection.connection
+    if backend == 'mysql':
+        from MySQLdb.cursors import SSCursor
+        streaming = raw.cursor(SSCursor)
+    elif backend == 'postgresql_psycopg2':
+        #Named cursors live on the server
+        streaming = raw.cursor('replicate_%s_%d' % (name, conduit.pk))
+        streaming.itersize = conduit.insert_chunk_size
+    else:
+        #cx_Oracle and sqlite3 fetch as they go, in arraysize round trips
+        streaming = connection.cursor()
+    streaming.arraysize = max(conduit.insert_chunk_size, 1)
+    return GuardedCursor(streaming, cursor.guard, conduit.major_timeout)
 
 
-def delete_rows(conduit, delete_list, cursor, table, keys_template):
-    logger_ec.debug(u'Conduit: %s; Starting rows delete...' % (conduit))
-    delete_rows = 0
-    for key in delete_list:
-        cursor.execute("DELETE FROM %s WHERE %s " % (table, (keys_template) % (tuple(key))))
-        deleted_rows += 1
-        
-    logger_ec.debug(u'Conduit: %s; deleted rows: %s' % (conduit, deleted_rows))        
+def streaming_select(db, guard, query):
+    """The session max_execution_time of MySQL would cut a streamed result
+    after [major timeout], the query gets the time left to the conduit instead"""
+    if db.backend == 'mysql' and query.startswith("SELECT "):
+        return "SELECT /*+ MAX_EXECUTION_TIME(%d) */ %s" % (int(guard.deadline.remaining() * 1000), query[len("SELECT "):])
+    return query
+
+
+def slave_ddl(conduit, slave_connection, slave_cursor, *queries):
+    """Run schema changes on the slave, committing them"""
+    for query in queries:
+        run_timed_query(slave_cursor, u'Conduit: %s; snapshot' % conduit, query, conduit.major_timeout)
+    slave_connection._commit()
+
+
+def drop_table(conduit, slave_connection, slave_cursor, table):
+    try:
+        slave_ddl(conduit, slave_connection, slave_cursor, "DROP TABLE %s" % table)
+    except:
+        slave_connection._rollback()
+
+
+def prepare_snapshot_table(conduit, slave_connection, slave_cursor):
+    """Empty the slave table or create the staging table, returns the table to load"""
+    backend = conduit.slave_db.backend
+    if conduit.snapshot == 'T':
+        if backend == 'sqlite3':
+            slave_ddl(conduit, slave_connection, slave_cursor, "DELETE FROM %s" % conduit.slave_table)
+        else:
+            slave_ddl(conduit, slave_connection, slave_cursor, "TRUNCATE TABLE %s" % conduit.slave_table)
+        return conduit.slave_table
+    elif conduit.snapshot == 'S':
+        staging = "%s_staging" % conduit.slave_table
+        drop_table(conduit, slave_connection, slave_cursor, staging)
+        if backend == 'mysql':
+            #Keeps the indexes
+            slave_ddl(conduit, slave_connection, slave_cursor, "CREATE TABLE %s LIKE %s" % (staging, conduit.slave_table))
+        elif backend in ('postgresql', 'postgresql_psycopg2'):
+            slave_ddl(conduit, slave_connection, slave_cursor, "CREATE TABLE %s (LIKE %s INCLUDING ALL)" % (staging, conduit.slave_table))
+        elif backend == 'ado_mssql':
+            slave_ddl(conduit, slave_connection, slave_cursor, "SELECT * INTO %s FROM %s WHERE 1 = 0" % (staging, conduit.slave_table))
+        else:
+            slave_ddl(conduit, slave_connection, slave_cursor, "CREATE TABLE %s AS SELECT * FROM %s WHERE 1 = 0" % (staging, conduit.slave_table))
+        return staging
+    return conduit.slave_table
+
+
+def swap_snapshot_table(conduit, slave_connection, slave_cursor, staging):
+    """Put the loaded staging table in place of the slave table"""
+    backend = conduit.slave_db.backend
+    table = conduit.slave_table
+    old = "%s_old" % table
+    drop_table(conduit, slave_connection, slave_cursor, old)
+    if backend == 'mysql':
+        #Atomic
+        slave_ddl(conduit, slave_connection, slave_cursor, "RENAME TABLE %s TO %s, %s TO %s" % (table, old, staging, table))
+    elif backend == 'ado_mssql':
+        slave_ddl(conduit, slave_connection, slave_cursor, "EXEC sp_rename '%s', '%s'" % (table, old), "EXEC sp_rename '%s', '%s'" % (staging, table))
+    else:
+        #Transactional on PostgreSQL and SQLite; Oracle commits each one
+        slave_ddl(conduit, slave_connection, slave_cursor, "ALTER TABLE %s RENAME TO %s" % (table, split_table_name(old)[1]), "ALTER TABLE %s RENAME TO %s" % (staging, split_table_name(table)[1]))
+    drop_table(conduit, slave_connection, slave_cursor, old)
+
+
+def snapshot_row_chunks(conduit, cursor, stats):
+    """Generator streaming all the master rows in chunks of [insert_chunk_size]"""
+    counters = stats.counters
+    while True:
+        rows = stats.timed('row_fetch', cursor.fetchmany, max(conduit.insert_chunk_size, 1))
+        if not rows:
+            break
+        for row in rows:
+            counters['bytes_transferred'] += row_size(row)
+        yield rows
+
+
+def snapshot_rows(conduit, master_connection, master_cursor, slave_connection, slave_cursor, fields_to_fetch, insert_template, stats):
+    """Copy every master row to the slave; returns True on completion"""
+    counters = stats.counters
+    logger_ec.debug(u'Conduit: %s; snapshot: %s' % (conduit, conduit.get_snapshot_display()))
+
+    table = conduit.slave_table
+    if not conduit.dry_run:
+        table = stats.timed('insert', prepare_snapshot_table, conduit, slave_connection, slave_cursor)
+        insert_template = insert_template.replace("INSERT INTO %s " % conduit.slave_table, "INSERT INTO %s " % table, 1)
+
+    cursor = streaming_cursor(conduit, conduit.master_db, master_connection, master_cursor, 'snapshot')
+    run_timed_query(cursor, u'Conduit: %s; snapshot_fetch' % conduit, streaming_select(conduit.master_db, master_cursor.guard, subset_query("SELECT %s" % fields_to_fetch, conduit.master_table, conduit.master_subset)), conduit.major_timeout)
+
+    writer = start_slave_writer(conduit, slave_connection, slave_cursor, table, insert_template, stats)
+    row_chunks = snapshot_row_chunks(conduit, cursor, stats)
+    if conduit.pipelined:
+        row_chunks = pipeline(conduit, row_chunks, master_cursor.guard)
+    try:
+        for rows in row_chunks:
+            if not stats.timed('insert', modify_slave_rows, conduit, slave_connection, slave_cursor, insert_template, rows, counters, writer=writer):
+                return
+            writer.processed(len(rows))
+    except ConduitAborted:
+        return
+    except:
+        writer.failed = True
+        raise
+    finally:
+        row_chunks.close()
+        cursor.close()
+        finish_slave_writer(conduit, writer, stats)
+
+    if conduit.snapshot == 'S' and not conduit.dry_run:
+        stats.timed('insert', swap_snapshot_table, conduit, slave_connection, slave_cursor, table)
+
+    logger_ec.info(u'Conduit: %s; Total rows copied from master db: %d.' % (conduit, counters['rows_inserted']))
+    return True
+
+
+def checkpointable(conduit):
+    return conduit.checkpoint_max_age and not conduit.incremental_column and not conduit.dry_run and not conduit.snapshot
+
+
+CHECKPOINT_METADATA = ('fingerprint', 'pk_column_names', 'master_query', 'slave_query', 'insert_template', 'fields_to_fetch', 'keys_template')
+
+
+def checkpoint_fingerprint(metadata):
+    """Checkpoints only outlive the metadata they were compared with; once it
+    is detected again with other columns (ie: after the "Clear cached metadata"
+    action on a changed table) they are discarded"""
+    return md5(u'\x00'.join([smart_unicode(metadata[name]) for name in CHECKPOINT_METADATA]).encode('utf-8')).hexdigest()
+
+
+def checkpoint_progress(conduit, checkpoint, stats):
+    """Save the keys of the append list not processed yet, clearing the
+    checkpoint if there are none left"""
+    fingerprint, created, append_list = checkpoint
+    try:
+        save_checkpoint(conduit, fingerprint, created, islice(append_list, stats.counters['keys_processed'], None))
+    except:
+        (exc_type, exc_info, tb) = sys.exc_info()
+        logger_ec.error(u'Conduit: %s; Saving checkpoint; %s' % (conduit, exc_info))
 
 
 def execute_conduit(conduit):
@@ -433,8 +1647,11 @@ def execute_conduit(conduit):
     #        a .fetch*() method.
 
     logger_ec.info(u"Conduit: %s; Started." % conduit)
+    stats = ConduitStats()
+    deadline = Deadline(conduit.timeout)
+    run = ConduitRun.objects.create(conduit=conduit, started=datetime.datetime.now(), status='R')
     try:
-        master_connection, master_cursor = open_database(conduit, conduit.master_db)
+        master_connection, master_cursor = stats.timed('connect', open_database, conduit, conduit.master_db, deadline)
     #except TimeLimitExpired:
     #    (exc_type, exc_info, tb) = sys.exc_info()
     #    logger_ec.error(u'Conduit: %s; db: %s; Timeout error.' % (conduit, db))
@@ -442,72 +1659,102 @@ def execute_conduit(conduit):
     except:
         (exc_type, exc_info, tb) = sys.exc_info()
         logger_ec.error(u'Conduit: %s; master backend: %s; %s.' % (conduit, conduit.master_db.backend, traceback.format_exception(exc_type, exc_info, None)[0]))
+        stats.save(run, exc_type is TimeLimitExpired and 'T' or 'F')
         return traceback.format_exception(exc_type, exc_info, None)        
 
     try:
-        slave_connection, slave_cursor = open_database(conduit, conduit.slave_db)
+        slave_connection, slave_cursor = stats.timed('connect', open_database, conduit, conduit.slave_db, deadline)
     except:
         (exc_type, exc_info, tb) = sys.exc_info()
         logger_ec.error(u'Conduit: %s; slave backend: %s; %s.' % (conduit, conduit.slave_db.backend, traceback.format_exception(exc_type, exc_info, None)[0]))
+        master_cursor.close()
+        connection_pool.release(conduit.master_db, master_connection)
+        stats.save(run, exc_type is TimeLimitExpired and 'T' or 'F')
         return traceback.format_exception(exc_type, exc_info, None)        
 
+    cached = False
+    #(comparison time, append list) when the progress can be checkpointed
+    checkpoint = None
     try:    
-        auto_backend, auto_table, auto_cursor, pk_column_names = determine_primary_keys(conduit, master_cursor, slave_cursor)
-    
-        master_query, slave_query, insert_template, fields_to_fetch, keys_template = assemble_queries(conduit, auto_backend, auto_table, auto_cursor, pk_column_names)
+        metadata, cached = determine_metadata(conduit, master_cursor, slave_cursor, stats)
+        pk_column_names = metadata['pk_column_names']
+        master_query = metadata['master_query']
+        slave_query = metadata['slave_query']
+        insert_template = metadata['insert_template']
+        fields_to_fetch = metadata['fields_to_fetch']
+        keys_template = metadata['keys_template']
+
+        #Keys get their own cursors, streaming comparisons are still reading
+        #them while rows are being fetched and inserted
+        master_key_cursor = master_cursor.guard.cursor(conduit.major_timeout)
+        slave_key_cursor = slave_cursor.guard.cursor(conduit.major_timeout)
+
+        delete_list = None
+        resumed = False
+        if conduit.snapshot:
+            completed = snapshot_rows(conduit, master_connection, master_cursor, slave_connection, slave_cursor, fields_to_fetch, insert_template, stats)
+        else:
+            diff_created = datetime.datetime.now()
+            resumed = checkpointable(conduit) and load_checkpoint(conduit, checkpoint_fingerprint(metadata))
+            if resumed:
+                diff_created, append_list = resumed
+                logger_ec.info(u'Conduit: %s; Resuming from the checkpoint of %s; %d keys left to append.' % (conduit, diff_created, len(append_list)))
+            elif conduit.incremental_column:
+                if conduit.delete_rows:
+                    logger_ec.warning(u'Conduit: %s; Deletes are not propagated by incremental conduits.' % conduit)
+                append_list, marks, last_mark = determine_incremental_append_list(conduit, master_key_cursor, slave_key_cursor, pk_column_names, stats)
+            else:
+                if conduit.delete_rows:
+                    delete_list = []
+                append_list = determine_append_list(conduit, master_key_cursor, slave_key_cursor, master_query, slave_query, pk_column_names, stats, delete_list)
 
-        append_list = determine_append_list(conduit, master_cursor, slave_cursor, master_query, slave_query)
-        
-        insert_rows(conduit, append_list, fields_to_fetch, keys_template, insert_template, master_cursor, slave_cursor)
-        
+            #Streamed comparisons have no list of keys to save
+            if checkpointable(conduit) and hasattr(append_list, '__len__'):
+                checkpoint = checkpoint_fingerprint(metadata), diff_created, append_list
+            
+            completed = insert_rows(conduit, append_list, fields_to_fetch, keys_template, insert_template, master_cursor, slave_connection, slave_cursor, pk_column_names, stats)
+
+            if checkpoint:
+                checkpoint_progress(conduit, checkpoint, stats)
+
+            if completed and conduit.incremental_column:
+                update_high_water_mark(conduit, append_list, marks, last_mark, stats.first_skipped)
+
+            #Resumed executions only append, the next full comparison catches up
+            if completed and conduit.update_rows and not resumed:
+                completed = update_rows(conduit, master_key_cursor, slave_key_cursor, fields_to_fetch, keys_template, master_cursor, slave_connection, slave_cursor, pk_column_names, stats)
+
+            if completed and delete_list is not None:
+                completed = delete_rows(conduit, delete_list, slave_connection, slave_cursor, keys_template, pk_column_names, stats)
+            
     except:
         (exc_type, exc_info, tb) = sys.exc_info()
         logger_ec.error(u'Conduit: %s; %s.' % (conduit, traceback.format_exception(exc_type, exc_info, None)[0]))
                
-        slave_cursor.close()
-        master_cursor.close()
-        master_connection.close()
-        slave_connection.close()
+        #The connections may be in the middle of something, don't reuse them
+        connection_pool.discard(conduit.master_db, master_connection)
+        connection_pool.discard(conduit.slave_db, slave_connection)
+        if checkpoint:
+            checkpoint_progress(conduit, checkpoint, stats)
+        if cached and exc_type is not TimeLimitExpired:
+            #The tables may have changed since the metadata was detected
+            store_metadata(conduit, None)
+        stats.save(run, exc_type is TimeLimitExpired and 'T' or 'F')
         return   
     
 
     #Cleanup
+    slave_key_cursor.close()
+    master_key_cursor.close()
     slave_cursor.close()
     master_cursor.close()
-    #slave_connection.commit()
-    master_connection.close()
-    slave_connection.close()
+    if master_cursor.guard.abandoned:
+        #Still being used by a pipeline reader
+        connection_pool.discard(conduit.master_db, master_connection)
+    else:
+        connection_pool.release(conduit.master_db, master_connection)
+    connection_pool.release(conduit.slave_db, slave_connection)
+    if cached and not completed:
+        store_metadata(conduit, None)
+    stats.save(run, completed and 'S' or 'F')
     logger_ec.info(u'Conduit: %s; Finished.' % (conduit))
-
-def execute_conduit_set(conduit_set):
-    logger_es.info(u"Executing conduit_set: %s." % conduit_set)
-    c_p_l = []
-    for conduit in conduit_set.conduits.all():
-        c_p = Process(target=execute_timed_conduit, args=(conduit,))
-        c_p_l.append(c_p)
-        c_p.start()
-        #If conduit concurrency flag not set, wait for each conduit before starting next
-        if not conduit_set.concurrent:
-            c_p.join()
-        
-    for c_p in c_p_l:
-        c_p.join()
-
-    logger_es.info(u"Finished executing conduit_set: %s." % conduit_set)
-    
-def execute_schedule(schedule):
-    """Execute a schedule, calling the associated conduit_set"""
-    django_connection.close() 
-    
-    logger_es.info(u"Schedule: %s; Started." % schedule)
-
-    schedule.executing = True
-    schedule.save()
-
-    execute_conduit_set(schedule.conduit_set)
-
-    logger_es.info(u"Schedule: %s; Finished." % schedule)
-
-    schedule.last_run = datetime.datetime.now()
-    schedule.executing = False
-    schedule.save()
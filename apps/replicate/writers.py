@@ -0,0 +1,223 @@
+import os
+import sys
+import logging
+import datetime
+import tempfile
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+from timeouts import TimeLimitExpired
+
+DEFAULT_REPLICATE_MYSQL_LOCAL_INFILE = True
+
+logger_ec = logging.getLogger('execute_conduit')
+
+
+class SlaveWriter(object):
+    """Inserts rows into the slave with the conduit's insert template, a
+    chunk per executemany and transaction.  Bulk writers replace load() with
+    the backend's own loader; rows of a chunk that failed to load are still
+    inserted one by one with insert()"""
+    name = 'insert'
+    failed = False
+
+    def __init__(self, conduit, connection, cursor, table, template, counters):
+        self.conduit = conduit
+        self.connection = connection
+        self.cursor = cursor
+        self.table = table
+        self.template = template
+        self.counters = counters
+
+    def begin(self):
+        pass
+
+    def load(self, rows):
+        self.cursor.executemany(self.template, rows)
+
+    def insert(self, row):
+        self.cursor.execute(self.template, row)
+
+    def commit(self):
+        self.connection._commit()
+
+    def rollback(self):
+        self.connection._rollback()
+
+    def processed(self, count):
+        """count more keys are dealt with, once committed"""
+        self.counters['keys_processed'] += count
+
+    def counted(self, counter, count):
+        """count more rows were written, once committed"""
+        self.counters[counter] += count
+
+    def finish(self):
+        pass
+
+
+def escape_value(value, backend):
+    """A value in the tab separated text format read by both PostgreSQL COPY
+    and MySQL LOAD DATA, with \\N for NULL"""
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        if backend == 'mysql':
+            return value and '1' or '0'
+        return value and 't' or 'f'
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat(' ')
+    if isinstance(value, float):
+        #str() rounds to 12 digits
+        return repr(value)
+    return smart_str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def write_rows(output, rows, backend):
+    for row in rows:
+        output.write('\t'.join([escape_value(value, backend) for value in row]))
+        output.write('\n')
+
+
+class CopyWriter(SlaveWriter):
+    """PostgreSQL COPY FROM STDIN (psycopg2) of each chunk, from a memory buffer"""
+    name = 'copy'
+
+    def load(self, rows):
+        buffer = StringIO()
+        write_rows(buffer, rows, 'postgresql')
+        buffer.seek(0)
+        self.cursor.timed(None, 'copy_expert', "COPY %s FROM STDIN" % self.table, buffer)
+
+
+class LoadDataWriter(SlaveWriter):
+    """MySQL LOAD DATA LOCAL INFILE of each chunk, spooled to a temporary file.
+    The server skips the rows it can't load (ie: duplicate keys) instead of
+    failing, a chunk that was not loaded whole is rolled back and inserted row
+    by row so the errors are still handled per row.  If the statement itself
+    fails (ie: local_infile disabled on the server) the rest of the run uses
+    executemany"""
+    name = 'load_data'
+    unavailable = False
+
+    def load(self, rows):
+        if self.unavailable:
+            return SlaveWriter.load(self, rows)
+
+        handle, filename = tempfile.mkstemp(prefix='replicate_')
+        try:
+            output = os.fdopen(handle, 'wb')
+            try:
+                write_rows(output, rows, 'mysql')
+            finally:
+                output.close()
+            try:
+                self.cursor.execute("LOAD DATA LOCAL INFILE %%s INTO TABLE %s CHARACTER SET utf8" % self.table, [filename])
+            except TimeLimitExpired:
+                raise
+            except:
+                #Row errors are only warnings with LOCAL, this chunk is retried row by row
+                self.unavailable = True
+                logger_ec.warning(u'Conduit: %s; LOAD DATA failed (%s), inserting with executemany for the rest of the run.' % (self.conduit, sys.exc_info()[1]))
+                raise
+        finally:
+            os.remove(filename)
+
+        if self.cursor.rowcount != len(rows):
+            raise ValueError('loaded %d of %d rows' % (self.cursor.rowcount, len(rows)))
+
+
+class SQLiteWriter(SlaveWriter):
+    """The whole load in a single SQLite transaction with synchronous writes
+    turned off; each chunk runs in a savepoint so a failing one can be undone
+    alone.  Keys and rows are only counted once the transaction commits"""
+    name = 'sqlite'
+
+    def begin(self):
+        self.connection._commit()
+        raw = self.connection.connection
+        #Transactions are handled here, not by the driver
+        self.isolation_level = raw.isolation_level
+        raw.isolation_level = None
+        self.cursor.execute("PRAGMA synchronous")
+        self.synchronous = self.cursor.fetchone()[0]
+        self.cursor.execute("PRAGMA synchronous = OFF")
+        self.cursor.execute("BEGIN")
+        self.uncommitted = {}
+
+    def savepoint(self, method, *args):
+        self.cursor.execute("SAVEPOINT replicate_chunk")
+        try:
+            method(self.template, *args)
+        except:
+            self.cursor.execute("ROLLBACK TO replicate_chunk")
+            self.cursor.execute("RELEASE replicate_chunk")
+            raise
+        self.cursor.execute("RELEASE replicate_chunk")
+
+    def load(self, rows):
+        self.savepoint(self.cursor.executemany, rows)
+
+    def insert(self, row):
+        self.savepoint(self.cursor.execute, row)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def processed(self, count):
+        self.counted('keys_processed', count)
+
+    def counted(self, counter, count):
+        self.uncommitted[counter] = self.uncommitted.get(counter, 0) + count
+
+    def finish(self):
+        try:
+            try:
+                self.cursor.execute("COMMIT")
+            except:
+                #The synchronous level can't be changed inside a transaction
+                (exc_type, exc_info, tb) = sys.exc_info()
+                try:
+                    self.cursor.execute("ROLLBACK")
+                except:
+                    pass
+                raise exc_type, exc_info, tb
+            for counter, count in self.uncommitted.items():
+                self.counters[counter] += count
+        finally:
+            self.uncommitted = {}
+            self.connection.connection.isolation_level = self.isolation_level
+            self.cursor.execute("PRAGMA synchronous = %d" % self.synchronous)
+
+
+WRITERS = {
+    'insert': (SlaveWriter, None),
+    'copy': (CopyWriter, ('postgresql_psycopg2',)),
+    'load_data': (LoadDataWriter, ('mysql',)),
+    'sqlite': (SQLiteWriter, ('sqlite3',)),
+}
+
+
+def automatic_writer(backend):
+    if backend == 'postgresql_psycopg2':
+        return 'copy'
+    elif backend == 'mysql' and getattr(settings, "REPLICATE_MYSQL_LOCAL_INFILE", DEFAULT_REPLICATE_MYSQL_LOCAL_INFILE):
+        return 'load_data'
+    elif backend == 'sqlite3':
+        return 'sqlite'
+    return 'insert'
+
+
+def slave_writer(conduit, connection, cursor, table, template, counters):
+    """The writer chosen for the conduit, or the fastest one for the slave backend"""
+    backend = conduit.slave_db.backend
+    name = conduit.slave_writer or automatic_writer(backend)
+    writer_class, backends = WRITERS[name]
+    if backends and backend not in backends:
+        raise ValueError('The %s slave writer does not support the %s backend' % (name, backend))
+    return writer_class(conduit, connection, cursor, table, template, counters)
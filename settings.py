@@ -117,6 +117,52 @@ TEMPLATE_CONTEXT_PROCESSORS = [
 #REPLICATE_CHECKSCHEDULES_FREQUENCY
 #Default is 45 seconds
 
+#REPLICATE_LOG_DB_LEVEL
+#Minimum level of the log records stored in the database, default is 'DEBUG'
+
+#REPLICATE_LOG_FLUSH_SIZE / REPLICATE_LOG_FLUSH_INTERVAL
+#Log records are written to the database in batches of this many records or
+#every this many seconds, defaults are 100 records and 2 seconds
+
+#REPLICATE_MAX_WORKERS
+#Maximum amount of conduits executing at the same time, default is 4
+
+#REPLICATE_MAX_WORKERS_PER_HOST
+#Maximum amount of conduits executing at the same time against a single host, default is 2
+
+#REPLICATE_POOL_MAX_IDLE
+#Seconds an idle master/slave database connection is kept open, default is 300
+
+#REPLICATE_POOL_MAX_PER_HOST
+#Maximum amount of open connections (idle or in use) to a single host, default is 8
+
+#REPLICATE_POOL_VALIDATION_INTERVAL
+#Idle connections released more than this many seconds ago are checked with a
+#trivial query before being reused, default is 30
+
+#REPLICATE_LOG_BUFFER_SIZE
+#Log records waiting to be written to the database are dropped beyond this
+#many, default is 10000
+
+#REPLICATE_MYSQL_LOCAL_INFILE
+#Load the rows into MySQL slaves with LOAD DATA LOCAL INFILE unless a conduit
+#chooses its slave writer, default is True
+
+#REPLICATE_AUTOSTART_SCHEDULER
+#Start the scheduler in every process loading the application, set it to False
+#when the schedules are run by the replicate_worker command, default is True
+
+#REPLICATE_WORKER_HEARTBEAT
+#Seconds between the heartbeats of a replicate_worker, default is 30
+
+#REPLICATE_WORKER_SHUTDOWN_TIMEOUT
+#Seconds a stopping replicate_worker waits for the running conduits before
+#terminating them, default is 300
+
+#REPLICATE_LEASE_MARGIN
+#Seconds a schedule or conduit lease outlives a node that stopped renewing it
+#(ie: crashed), default is 60
+
 try:
     from settings_local import *
 except ImportError: